@@ -1,33 +1,129 @@
 import datetime as dt
-
-from flask import current_app, has_app_context, abort, request, redirect, flash
-from flask_admin import Admin, expose, AdminIndexView
+import gzip
+import hashlib
+import io
+import time
+import typing
+
+from flask import current_app, has_app_context, abort, request, redirect, \
+    flash, jsonify, get_template_attribute, make_response, session, url_for
+from flask_admin import Admin, BaseView, expose, AdminIndexView
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView as SQLAlchemyModelView
 from flask_admin.contrib.sqla.filters import EnumEqualFilter
 from flask_admin.contrib.sqla.form import get_form
 from flask_admin.model.form import create_editable_list_form
-from flask_babelex import gettext as _, lazy_gettext as _l
+from flask_babelex import gettext as _, lazy_gettext as _l, get_locale, \
+    get_timezone
 from flask_security import current_user, login_required
+from flask_wtf.csrf import validate_csrf
+from markupsafe import Markup, escape
 import sqlalchemy as sa
 import wtforms as wtf
 
+import archive
+import exchange
 import model
-from form import QuestionForm, \
+import profiler
+from form import QuestionForm, ClusterForm, PackageForm, ProfilerForm, \
     QuizEditorForm, BlockEditorForm, QuestionEditorForm, ChoiceEditorForm
 
 
+# Node type: (model class, editor form, parent class, parent key)
+EDITOR_NODES = {
+    'block': (model.Block, BlockEditorForm, model.Quiz, 'quiz_id'),
+    'question': (model.Question, QuestionEditorForm, model.Block, 'block_id'),
+    'choice': (model.Choice, ChoiceEditorForm, model.Question, 'question_id'),
+}
+
+# Node type: (macro of new node, macro of edited node) in _editor_tree.html
+EDITOR_MACROS = {
+    'block': ('block_well', 'block_header'),
+    'question': ('question_well', 'question_header'),
+    'choice': ('choice_row', 'choice_row'),
+}
+
+
+def node_quiz(node: model.db.Model) -> model.Quiz:
+    """Returns the quiz an editor node belongs to."""
+    if isinstance(node, model.Choice):
+        node = node.question
+    if isinstance(node, model.Question):
+        node = node.block
+    if isinstance(node, model.Block):
+        node = node.quiz
+    return node
+
+
+def can_edit_quiz(quiz: model.Quiz) -> bool:
+    """Returns if the current user may edit the quiz."""
+    if quiz is None or not current_user.has_role('editor'):
+        return False
+    return current_user.has_role('admin') or quiz.host_id == current_user.id
+
+
+def view_etag(*parts) -> str:
+    """Returns the ETag of a page rendered from parts for the current user.
+
+    The database, user, locale and timezone are part of every tag, so the
+    tag changes with anything else the page is rendered from.
+    """
+    parts += (model.database_key(), current_user.get_id(), get_locale(),
+              get_timezone())
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def conditional_response(
+        etag: str,
+        render: typing.Callable,
+        shared: bool = False):
+    """Answers 304 if the client has the page of etag, renders it otherwise.
+
+    Pages with pending flash messages are always rendered and not tagged.
+
+    :param etag: Tag of the current version of the page.
+    :param render: Function rendering the page.
+    :param shared: Keep the rendered page in the application cache under
+        its tag for `CACHE_PAGE_SECONDS`, so every worker can serve it.
+    """
+    if session.get('_flashes'):
+        return render()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    elif shared and 'cache' in current_app.extensions:
+        cache = current_app.extensions['cache']
+        timeout = current_app.config.get('CACHE_PAGE_SECONDS', 300)
+        response = make_response(
+            cache.get_or_create(f'page:{etag}', render, timeout))
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 class IndexView(AdminIndexView):
 
     @expose('/')
     def index(self, page: int = 1):
         per_page = current_app.config.get('PER_PAGE', 20)
-        quizzes = model.Quiz.query\
-            .order_by(model.Quiz.start_time_utc.desc())\
-            .order_by(model.Quiz.id.desc())\
-            .filter_by(public=True)\
-            .paginate(page, per_page, error_out=False)
-
-        return self.render('index.html', quizzes=quizzes)
+        state = model.db.session.query(
+            sa.func.count(model.Quiz.id),
+            sa.func.max(model.Quiz.id),
+            sa.func.sum(model.Quiz.revision))\
+            .filter_by(public=True).one()
+        etag = view_etag('index', page, per_page, tuple(state))
+
+        def render():
+            quizzes = model.Quiz.query\
+                .order_by(model.Quiz.start_time_utc.desc())\
+                .order_by(model.Quiz.id.desc())\
+                .filter_by(public=True)\
+                .paginate(page, per_page, error_out=False)
+            return self.render('index.html', quizzes=quizzes)
+
+        return conditional_response(etag, render)
 
     @expose('/form', methods=['GET', 'POST', 'DELETE'])
     @login_required
@@ -79,6 +175,159 @@ class IndexView(AdminIndexView):
 
         return redirect(request.referrer)
 
+    @staticmethod
+    def _editor_node(node_type: str, node: model.db.Model,
+                     created: bool = False) -> dict:
+        parent_key = EDITOR_NODES[node_type][3]
+        macro = EDITOR_MACROS[node_type][0 if created else 1]
+        return {
+            'type': node_type,
+            'id': node.id,
+            'parent_id': getattr(node, parent_key),
+            'created': created,
+            'data': node.to_dict(),
+            'html': get_template_attribute('_editor_tree.html', macro)(node)
+        }
+
+    @staticmethod
+    def _json_data() -> dict:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return abort(400)
+        if current_app.config.get('WTF_CSRF_ENABLED', True):
+            try:
+                validate_csrf(data.get('csrf_token'))
+            except wtf.ValidationError:
+                return abort(400)
+        return data
+
+    @expose('/editor/<node_type>', methods=['POST'])
+    @login_required
+    def editor_create(self, node_type: str):
+        if node_type not in EDITOR_NODES:
+            return abort(404)
+        model_class, form_class, parent_class, parent_key \
+            = EDITOR_NODES[node_type]
+
+        data = self._json_data()
+        parent = parent_class.query.get(data.get(parent_key, 0))
+        if parent is None:
+            return abort(404)
+        if not can_edit_quiz(node_quiz(parent)):
+            return abort(403)
+
+        form = form_class(None, parent)
+        form.load_json(data)
+        if not form.validate():
+            return jsonify(errors=form.errors), 400
+
+        form.save_model()
+        model.db.session.add(form.model)
+        model.db.session.commit()
+        return jsonify(self._editor_node(node_type, form.model, True)), 201
+
+    @expose('/editor/<node_type>/<int:node_id>', methods=['PUT', 'DELETE'])
+    @login_required
+    def editor_node(self, node_type: str, node_id: int):
+        if node_type not in EDITOR_NODES:
+            return abort(404)
+        model_class, form_class = EDITOR_NODES[node_type][:2]
+
+        data = self._json_data()
+        node = model_class.query.get(node_id)
+        if node is None:
+            return abort(404)
+        if not can_edit_quiz(node_quiz(node)):
+            return abort(403)
+
+        if request.method == 'DELETE':
+            model.db.session.delete(node)
+            model.db.session.commit()
+            return jsonify(type=node_type, id=node_id, deleted=True)
+
+        form = form_class(node)
+        form.load_json(data)
+        if not form.validate():
+            return jsonify(errors=form.errors), 400
+
+        form.save_model()
+        model.db.session.commit()
+        return jsonify(self._editor_node(node_type, node))
+
+    @expose('/editor/search')
+    @login_required
+    def editor_search(self):
+        if not current_user.has_role('editor'):
+            return abort(403)
+
+        search = current_app.extensions['search']
+        host_id = None if current_user.has_role('admin') else current_user.id
+        hits = search.search(request.args.get('q', ''), host_id=host_id)
+
+        results = []
+        for hit in hits:
+            url = url_for('quiz.edit_view', id=hit.quiz_id)
+            if hit.question_id is not None:
+                url += f'#question-{hit.question_id}'
+            results.append(dict(hit.to_dict(), url=url))
+        return jsonify(results=results)
+
+    @expose('/editor/<node_type>/order', methods=['POST'])
+    @login_required
+    def editor_order(self, node_type: str):
+        if node_type not in ('block', 'question'):
+            return abort(404)
+        model_class, _form_class, _parent_class, parent_key \
+            = EDITOR_NODES[node_type]
+
+        data = self._json_data()
+        try:
+            ids = [int(x) for x in data.get('ids', [])]
+        except (TypeError, ValueError):
+            return abort(400)
+
+        nodes = model_class.query.filter(model_class.id.in_(ids)).all()
+        parents = {getattr(x, parent_key) for x in nodes}
+        if not nodes or len(nodes) != len(ids) or len(parents) != 1:
+            return abort(400)
+        if not can_edit_quiz(node_quiz(nodes[0])):
+            return abort(403)
+
+        # Every sibling is renumbered, so none can share a number with them.
+        siblings = {x for (x,) in model.db.session.query(model_class.id)
+                    .filter(getattr(model_class, parent_key) == parents.pop())}
+        if siblings != set(ids):
+            return abort(400)
+
+        # Set on the instances, so the flush bumps the quiz revision.
+        order = {node_id: i for (i, node_id) in enumerate(ids, start=1)}
+        for node in nodes:
+            node.order_number = order[node.id]
+        model.db.session.commit()
+
+        nodes.sort(key=lambda x: x.order_number)
+        return jsonify(nodes=[self._editor_node(node_type, x) for x in nodes])
+
+
+    @staticmethod
+    def _pager_state(pager: model.Pager, active: int = None) -> dict:
+        block = pager.block
+        return {
+            'revision': pager.fill.quiz.revision,
+            'block': block.order_number,
+            'finish': pager.finish,
+            'finish_url': url_for('admin.quiz', quiz_id=pager.quiz_id,
+                                  block=block.order_number, finish=True),
+            'questions': [{
+                'order_number': x.order_number,
+                'available': x.available,
+                'answered': x.answered,
+                'active': x.order_number == active,
+                'url': url_for('admin.quiz', quiz_id=pager.quiz_id,
+                               block=block.order_number,
+                               question=x.order_number)
+            } for x in pager.questions]
+        }
 
     @expose('/<int:quiz_id>/pager')
     def pager(self, quiz_id: int):
@@ -90,20 +339,94 @@ class IndexView(AdminIndexView):
         fill = model.FilledQuiz.query\
             .filter_by(user_id=current_user.id)\
             .filter_by(quiz_id=quiz_id).first()
+        if fill is None:
+            return abort(404)
 
-        block = fill.current_block
-        if block is None:
+        step = model.quiz_timeline(quiz).step(fill.start_time_utc)
+        etag = view_etag('pager', quiz.revision, fill.id, fill.version,
+                         step, active)
+
+        def render():
+            pager = model.Pager(fill)
+            if pager.block is None:
+                return abort(404)
+            return self.render("pager.html", pager=pager, active=active)
+
+        return conditional_response(etag, render, shared=True)
+
+    @expose('/<int:quiz_id>/timeline')
+    @login_required
+    def timeline(self, quiz_id: int):
+        """Returns the unlock offsets of the questions of the quiz.
+
+        The browser computes the available questions from them and the
+        start time, and revalidates them when a question unlocks and every
+        minute, which costs a 304 until the quiz is edited. The
+        `X-Server-Time` header has the clock of the server in milliseconds.
+        """
+        quiz = model.Quiz.query.get(quiz_id)
+        if quiz is None:
             return abort(404)
 
-        questions = fill.available_questions
-        finish = True
-        for question in questions:
-            if question.answers.filter_by(quiz_id=fill.id).first() is None:
-                finish = False
-                break
+        fill = model.FilledQuiz.query\
+            .filter_by(user_id=current_user.id)\
+            .filter_by(quiz_id=quiz_id).first()
+        if fill is None:
+            return abort(404)
+
+        start_time_utc = fill.start_time_utc
+        etag = view_etag('timeline', quiz.revision, start_time_utc)
 
-        return self.render("pager.html", questions=questions,
-                           finish=finish, active=active)
+        def render():
+            start = None
+            if start_time_utc is not None:
+                start = int(start_time_utc.replace(
+                    tzinfo=dt.timezone.utc).timestamp() * 1000)
+            return jsonify(revision=quiz.revision, start=start,
+                           blocks=model.quiz_timeline(quiz).manifest())
+
+        response = conditional_response(etag, render)
+        response.headers['X-Server-Time'] = str(int(time.time() * 1000))
+        return response
+
+    @expose('/<int:quiz_id>/<int:block>/<int:question>/answer',
+            methods=['POST'])
+    @login_required
+    def answer(self, quiz_id: int, block: int, question: int):
+        data = self._json_data()
+
+        fill = model.FilledQuiz.query\
+            .filter_by(user_id=current_user.id)\
+            .filter_by(quiz_id=quiz_id).first()
+        if fill is None:
+            return abort(404)
+
+        pager = model.Pager(fill)
+        item = pager.get(question)
+        if pager.block is None or pager.block.order_number != block \
+                or item is None or not item.available:
+            return abort(403)
+
+        key = model.answer_keys(fill.quiz)[item.id]
+        value = data.get('answer')
+        if key.show_choices:
+            if not isinstance(value, list):
+                value = [] if value is None else [value]
+            if not key.multiple and len(value) > 1:
+                return jsonify(errors={'answer': [_('Select one choice.')]}), 400
+            if not all(type(x) is int and x in key.points for x in value):
+                return jsonify(errors={'answer': [_('Invalid choice.')]}), 400
+            answered = fill.save_answer(key, choice_ids=value)
+        else:
+            if value is not None and not isinstance(value, str) \
+                    or value and len(value) > 255:
+                return jsonify(errors={'answer': [_('Invalid answer.')]}), 400
+            answered = fill.save_answer(key, text=value)
+
+        item.answered = answered
+        state = self._pager_state(pager, item.order_number)
+        model.db.session.commit()
+        return jsonify(saved=True, pager=state)
 
     @expose('/<int:quiz_id>/',
             methods=['GET', 'POST'])
@@ -114,7 +437,7 @@ class IndexView(AdminIndexView):
     @login_required
     def quiz(self, quiz_id: int, block: int = None, question: int = None):
         quiz = model.Quiz.query.get(quiz_id)
-        if quiz is None:
+        if quiz is None or quiz.archived_utc is not None:
             return abort(404)
 
         fill = model.FilledQuiz.query\
@@ -122,10 +445,7 @@ class IndexView(AdminIndexView):
             .filter_by(quiz_id=quiz_id).first()
 
         if fill is None:
-            fill = model.FilledQuiz(
-                user_id=current_user.id,
-                quiz_id=quiz_id)
-            model.db.session.add(fill)
+            fill = model.FilledQuiz.get_or_create(current_user.id, quiz_id)
             model.db.session.commit()
 
         if block is None:
@@ -141,35 +461,26 @@ class IndexView(AdminIndexView):
             block = quiz.blocks.order_by(model.Block.order_number).first()
 
         if block in fill.finished_blocks:
-            answers = fill.answers\
-                .join(model.Question)\
-                .filter(model.Question.block_id == block.id)\
-                .order_by(model.Question.order_number)
+            etag = view_etag('results', quiz.revision, fill.id, fill.version,
+                             block.id)
 
-            block_points = model.int_or_float(
-                sum([ans.points for ans in answers])
-            )
-            return self.render('answers.html', block=block,
-                               answers=answers,
-                               block_points=block_points,
-                               total=fill.points)
+            def render():
+                current_app.extensions['grader'].wait(fill.id)
+                results = model.BlockResults(fill, block)
+                return self.render(
+                    'answers.html', block=block, results=results)
 
-        question = question or 1
-        question = block.questions\
-            .filter_by(order_number = question)\
-            .first()
+            return conditional_response(etag, render, shared=True)
 
-        if question not in fill.available_questions:
+        pager = model.Pager(fill)
+        item = pager.get(question or 1)
+        if pager.block is None or block.id != pager.block.id \
+                or item is None or not item.available:
             return abort(403)
 
-        if block == fill.current_block:
-            form = QuestionForm.from_model(question, fill)
-            return self.render('quiz.html', form=form)
-        else:
-            answer = fill.answers\
-                .filter(model.Answer.question_id == question.id)\
-                .first()
-            return self. render('answer.html', answer=answer)
+        form = QuestionForm.from_model(item.question, fill)
+        return self.render('quiz.html', form=form,
+                           state=self._pager_state(pager, item.order_number))
 
 
 admin = Admin(
@@ -205,7 +516,7 @@ def query_filter(model_class, label: str = None, flt = None):
     if label is None:
         label = _l(model_class.__name__)
 
-    if flt:
+    if flt is not None:
         qry = model_class.query.filter(flt)
     else:
         qry = model_class.query
@@ -229,10 +540,18 @@ class ModelView(SQLAlchemyModelView):
 
     column_extra_fields = {}
 
+    def _handle_view(self, name, **kwargs):
+        # Filters and forms list database rows, so they are refreshed for
+        # the view being handled, not for every view in the menu, and only
+        # once the user may access it.
+        response = super()._handle_view(name, **kwargs)
+        if response is None:
+            self._refresh_filters_cache()
+            self._refresh_forms_cache()
+        return response
+
     def is_accessible(self) -> bool:
         """Returns if page can be accessed by user."""
-        self._refresh_filters_cache()
-        self._refresh_forms_cache()
         if current_user.is_authenticated:
             return current_user.has_any_role(*self.roles)
         else:
@@ -336,6 +655,7 @@ class ModelView(SQLAlchemyModelView):
 
 @add_view(_l('Quizzes'), None, model.Quiz)
 class QuizView(ModelView):
+    list_template = "quiz_list.html"
     create_template = "create.html"
     edit_template = "edit.html"
 
@@ -371,9 +691,88 @@ class QuizView(ModelView):
             form.load_model()
         return form
 
+    def after_model_delete(self, quiz: model.Quiz):
+        shards = current_app.extensions.get('shards')
+        if shards is not None:
+            shards.drop(quiz.id)
+
+    @action('clone', _l('Duplicate'))
+    def action_clone(self, ids):
+        quizzes = self.get_query()\
+            .filter(model.Quiz.id.in_(ids))\
+            .order_by(model.Quiz.id).all()
+        for quiz in quizzes:
+            name = model.free_quiz_name(_('%(name)s (copy)', name=quiz.name))
+            model.clone_quiz(quiz, name, current_user.id)
+        model.db.session.commit()
+        flash(_('%(num)s quizzes duplicated.', num=len(quizzes)))
+
+    @action('export', _l('Export'))
+    def action_export(self, ids):
+        quizzes = self.get_query().filter(model.Quiz.id.in_(ids)).all()
+        if len(quizzes) != 1:
+            flash(_('Select one quiz to export.'), 'error')
+            return redirect(self.get_url('.index_view'))
+
+        text = io.StringIO()
+        exchange.export_quiz(quizzes[0], text)
+        response = make_response(gzip.compress(text.getvalue().encode()))
+        response.mimetype = 'application/gzip'
+        response.headers['Content-Disposition'] = \
+            f'attachment; filename=quiz-{quizzes[0].id}.jsonl.gz'
+        return response
+
+    @expose('/import/', methods=['GET', 'POST'])
+    def import_view(self):
+        if not self.can_create:
+            return abort(403)
+
+        form = PackageForm()
+        if form.validate_on_submit():
+            try:
+                with exchange.open_package(form.package.data.stream) as f:
+                    quiz = exchange.import_quiz(
+                        f, current_user.id, form.name.data or None)
+            except (ValueError, OSError) as e:
+                model.db.session.rollback()
+                flash(_('Invalid package: %(error)s', error=e), 'error')
+            else:
+                model.db.session.commit()
+                flash(_('Quiz imported.'))
+                return redirect(self.get_url('.edit_view', id=quiz.id))
+
+        return self.render('import.html', form=form)
+
+
+class ShardedModelView(ModelView):
+    """Model view of the fills or answers of a quiz chosen by the user.
+
+    If sharding is enabled, the quiz is chosen with the `shard` argument
+    and kept in the session, and the list, the forms and the exports use
+    its shard. `shard=0` shows the fills in the main database.
+    """
+    list_template = 'shard_list.html'
+
+    def _handle_view(self, name, **kwargs):
+        shards = current_app.extensions.get('shards')
+        if shards is not None:
+            if 'shard' in request.args:
+                session['shard'] = request.args.get('shard', 0, type=int)
+            shards.select(session.get('shard') or None)
+        return super()._handle_view(name, **kwargs)
+
+    def render(self, template, **kwargs):
+        shards = current_app.extensions.get('shards')
+        if shards is not None:
+            kwargs['shard_quizzes'] = model.Quiz.query\
+                .filter(model.Quiz.id.in_(shards.quiz_ids()))\
+                .order_by(model.Quiz.start_time_utc.desc()).all()
+            kwargs['shard'] = session.get('shard') or 0
+        return super().render(template, **kwargs)
+
 
 @add_view(_l('Filled Quizzes'), _l('Check'), model.FilledQuiz)
-class FilledQuizView(ModelView):
+class FilledQuizView(ShardedModelView):
     roles = ['editor']
 
     columns = {
@@ -389,7 +788,7 @@ class FilledQuizView(ModelView):
 
 
 @add_view(_l('Answers'), _l('Check'), model.Answer)
-class AnswerView(ModelView):
+class AnswerView(ShardedModelView):
     roles = ['editor']
 
     columns = {
@@ -403,6 +802,105 @@ class AnswerView(ModelView):
         # noinspection PyTypeChecker
         return [query_filter(model.FilledQuiz)]
 
+    @expose('/grade/<int:question_id>', methods=['GET', 'POST'])
+    def grade_view(self, question_id: int):
+        """Groups the text answers of a question for grading.
+
+        A cluster of answers is accepted by adding its most common
+        spelling as a choice matching the normalised text exactly, which
+        rescores every answer of the cluster.
+        """
+        question = model.Question.query.get(question_id)
+        if question is None:
+            return abort(404)
+        quiz = question.block.quiz
+        if not can_edit_quiz(quiz):
+            return abort(403)
+
+        shards = current_app.extensions.get('shards')
+        if shards is not None:
+            shards.select_quiz(quiz.id)
+
+        form = ClusterForm()
+        if form.validate_on_submit():
+            if form.points.data <= 0:
+                flash(_('Accepted answers must be worth points.'), 'error')
+            else:
+                model.db.session.add(model.Choice(
+                    question_id=question.id,
+                    value=form.value.data,
+                    points=form.points.data,
+                    max_levenshtein_distance=1
+                ))
+                model.db.session.commit()
+                flash(_('Answer accepted.'), 'success')
+                return redirect(request.url)
+
+        tree = model.QuizTree(quiz)
+        questions = [x for block in tree.blocks
+                     for x in tree.questions[block.id]
+                     if not x.show_choices]
+        ids = [x.id for x in questions]
+        index = ids.index(question.id) if question.id in ids else None
+        prev_question = ids[index - 1] if index else None
+        next_question = ids[index + 1] \
+            if index is not None and index + 1 < len(ids) else None
+
+        return self.render(
+            'grade.html',
+            question=question,
+            clusters=model.answer_clusters(question),
+            form=form,
+            prev_question=prev_question,
+            next_question=next_question
+        )
+
+
+@add_view(_l('Results'), _l('Check'), model.QuizResult)
+class QuizResultView(ModelView):
+    """Final points of archived quizzes, with their archived answers."""
+    roles = ['editor']
+
+    columns = {
+        'quiz': _l('Quiz'),
+        'user': _l('User'),
+        'points': _l('Points')
+    }
+    column_formatters = {
+        'quiz': lambda view, context, result, name: Markup(
+            f'<a href="{url_for(".archive_view", quiz_id=result.quiz_id)}">'
+            f'{escape(result.quiz)}</a>')
+    }
+
+    @property
+    def _column_filters(self):
+        # noinspection PyTypeChecker
+        return [query_filter(
+            model.Quiz, flt=model.Quiz.archived_utc.isnot(None))]
+
+    @expose('/archive/<int:quiz_id>')
+    def archive_view(self, quiz_id: int):
+        quiz = model.Quiz.query.get(quiz_id)
+        data = archive.load_archive(quiz_id)
+        if quiz is None or data is None:
+            return abort(404)
+
+        tree = model.QuizTree(quiz)
+        labels = {question.id: (block.order_number, question.order_number)
+                  for block in tree.blocks
+                  for question in tree.questions[block.id]}
+        users = dict(model.db.session.query(model.User.id, model.User.username)
+                     .filter(model.User.id.in_(
+                         [x['user_id'] for x in data['fills']])))
+
+        fills = sorted(data['fills'], key=lambda x: -x['points'])
+        for fill in fills:
+            fill['answers'].sort(
+                key=lambda x: labels.get(x['question_id'], (0, 0)))
+
+        return self.render('archive.html', quiz=quiz, fills=fills,
+                           users=users, labels=labels)
+
 
 @add_view(_l('Users'), _l('Admin'), model.User)
 class UserView(ModelView):
@@ -426,3 +924,57 @@ class UserView(ModelView):
         # noinspection PyTypeChecker
         return [query_filter(model.User)]
 
+    # The identity is dropped after the commit, so a request in between
+    # can not cache the old user again.
+    def after_model_change(self, form, user: model.User, is_created: bool):
+        current_app.extensions['identities'].invalidate(user.id)
+
+    def after_model_delete(self, user: model.User):
+        current_app.extensions['identities'].invalidate(user.id)
+        shards = current_app.extensions.get('shards')
+        if shards is not None:
+            shards.delete_user(user.id)
+
+
+@add_view(_l('Profiler'), _l('Admin'))
+class ProfilerView(BaseView):
+    """Switches the sampling profiler and shows the recorded stacks."""
+
+    def is_accessible(self) -> bool:
+        return current_user.is_authenticated and current_user.has_role('admin')
+
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        extension = current_app.extensions['profiler']
+        form = ProfilerForm(
+            enabled=extension.settings['enabled'],
+            rate=extension.settings['rate'],
+            endpoints='\n'.join(extension.settings['endpoints']))
+
+        if form.validate_on_submit():
+            if form.clear.data:
+                extension.clear()
+                flash(_('Samples cleared.'))
+            else:
+                extension.configure(
+                    form.enabled.data,
+                    form.rate.data,
+                    [x.strip() for x in form.endpoints.data.splitlines()
+                     if x.strip()])
+                flash(_('Successful edit!'))
+            return redirect(self.get_url('.index'))
+
+        stacks = extension.collect()
+        return self.render('profiler.html', form=form,
+                           samples=sum(stacks.values()),
+                           functions=profiler.top_functions(stacks))
+
+    @expose('/stacks.txt')
+    def stacks_view(self):
+        stacks = current_app.extensions['profiler'].collect()
+        response = make_response(''.join(
+            f'{stack} {count}\n' for stack, count in sorted(stacks.items())))
+        response.mimetype = 'text/plain'
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=stacks.txt'
+        return response
@@ -1,16 +1,39 @@
+# Imported first, so the startup time includes the other imports.
+import startup
+
+import logging
 import os
+import sys
+import time
 
+import click
 from flask import Flask, request
 from flask_babelex import Babel, Domain, lazy_gettext as _l
 from flask_bootstrap import Bootstrap
-from flask_migrate import Migrate, migrate, upgrade
+from flask_migrate import Migrate
 from flask_security import Security, SQLAlchemyUserDatastore, \
     LoginForm, current_user
 import wtforms as wtf
 
+from assets import Assets
+from cache import Cache
 from config import Config
+from grading import Grader
+from identity import Identities
+from profiler import Profiler
+from scheduler import Scheduler
+from search import Search
+from shards import Shards
+from traffic import TrafficRecorder
 import model
 import admin
+import archive
+import benchmark
+import diagnostics
+import engines
+import exchange
+import traffic
+import warmup
 
 
 app = Flask(__name__)
@@ -20,7 +43,10 @@ app.config.from_object(Config)
 
 model.db.init_app(app)
 migrations_dir = app.config.get('MIGRATE_DIRECTORY', 'data/migrations')
-Migrate(app, model.db, migrations_dir, render_as_batch=True)
+Migrate(app, model.db, migrations_dir, render_as_batch=True,
+        include_object=model.include_object)
+Shards(app)
+Cache(app)
 
 # Security ---------------------------------------------------------------------
 
@@ -32,11 +58,19 @@ Security(
     app,
     SQLAlchemyUserDatastore(model.db, model.User, model.Role)
 )
+Identities(app)
 
 # Frontend ---------------------------------------------------------------------
 
 admin.admin.init_app(app)
 Bootstrap(app)
+assets = Assets(app)
+warmup.init_bytecode_cache(app)
+Scheduler(app)
+Grader(app)
+search = Search(app)
+Profiler(app)
+TrafficRecorder(app)
 
 # Translations -----------------------------------------------------------------
 
@@ -59,11 +93,163 @@ def get_timezone():
         return
 
 
+# Startup ----------------------------------------------------------------------
+
+@app.before_first_request
+def report_startup():
+    app.logger.log(
+        logging.getLevelName(app.config['STARTUP_LOG_LEVEL']),
+        f'First request {time.perf_counter() - startup.started:.2f} s '
+        f'after start')
+
+
+# Commands ---------------------------------------------------------------------
+
+@app.cli.command('warm-up')
+def warm_up():
+    """Compiles the templates into the bytecode cache."""
+    for name in warmup.compile_templates(app):
+        print(name)
+
+
+@app.cli.command('check-queries')
+def check_queries():
+    """Fails if a key view's query count grows with the quiz size."""
+    counts, failures = diagnostics.check_query_budgets(app)
+    budgets = app.config.get('QUERY_BUDGETS', {})
+    for name, (small, large) in counts.items():
+        budget = budgets.get(name)
+        print(f'{name:24} small: {small:4}  large: {large:4}  '
+              f'budget: {budget if budget is not None else "-"}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if failures:
+        sys.exit(1)
+
+
+@app.cli.command('check-plans')
+def check_plans():
+    """Fails if a hot lookup does not use its index."""
+    plans, failures = diagnostics.check_query_plans(app)
+    for name, plan in plans.items():
+        print(f'{name}:')
+        for step in plan:
+            print(f'    {step}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if failures:
+        sys.exit(1)
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Builds fingerprinted and compressed copies of the static files."""
+    for source, target in assets.build().items():
+        print(f'{source} -> {target}')
+
+
+@app.cli.command('archive')
+@click.option('--days', type=int, default=None,
+              help='Archive quizzes ended more than this many days ago, '
+                   'ARCHIVE_AFTER_DAYS if not given.')
+def archive_quizzes(days):
+    """Archives the fills and answers of finished quizzes."""
+    if days is None:
+        days = app.config.get('ARCHIVE_AFTER_DAYS')
+    if days is None:
+        raise click.UsageError('Give --days or set ARCHIVE_AFTER_DAYS.')
+    for quiz in archive.archive_finished(days):
+        print(f'{quiz.id}: {quiz.name}')
+
+
+@app.cli.command('search-index')
+def search_index():
+    """Rebuilds the full-text search index."""
+    with model.db.engine.begin() as connection:
+        if search.ensure_index(connection):
+            print(f'{search.rebuild(connection)} rows indexed.')
+
+
+@app.cli.command('merge-fills')
+def merge_fills():
+    """Merges duplicate fills of the same user and quiz."""
+    print(f'{model.merge_duplicate_fills()} duplicate fills removed.')
+
+
+@app.cli.command('export-quiz')
+@click.argument('quiz_id', type=int)
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def export_quiz(quiz_id, path):
+    """Writes a quiz into a package, gzipped if path ends in .gz."""
+    quiz = model.Quiz.query.get(quiz_id)
+    if quiz is None:
+        raise click.ClickException(f'Quiz {quiz_id} does not exist.')
+    with open(path, 'wb') as file, exchange.open_package(file, 'w') as f:
+        count = exchange.export_quiz(quiz, f)
+    print(f'{count} rows exported.')
+
+
+@app.cli.command('import-quiz')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--host', required=True, help='Username of the host.')
+@click.option('--name', default=None, help='Name of the imported quiz.')
+def import_quiz(path, host, name):
+    """Creates a quiz from a package."""
+    user = model.User.query.filter_by(username=host).first()
+    if user is None:
+        raise click.ClickException(f'User {host} does not exist.')
+    with open(path, 'rb') as file, exchange.open_package(file) as f:
+        try:
+            quiz = exchange.import_quiz(f, user.id, name)
+        except (ValueError, OSError) as e:
+            model.db.session.rollback()
+            raise click.ClickException(str(e))
+    model.db.session.commit()
+    print(f'{quiz.id}: {quiz.name}')
+
+
+@app.cli.command('benchmark')
+@click.option('--profile', 'profiles', multiple=True,
+              type=click.Choice(sorted(engines.PROFILES)),
+              help='Engine profile to run, all of them if not given.')
+@click.option('--players', type=int, default=20,
+              help='Number of concurrent players.')
+@click.option('--seconds', type=float, default=10,
+              help='Duration of the run of each profile.')
+@click.option('--postgresql-uri', default=None,
+              help='Empty PostgreSQL database for the PostgreSQL profiles.')
+def run_benchmark(profiles, players, seconds, postgresql_uri):
+    """Runs the quiz-night workload with each engine profile."""
+    profiles = profiles or sorted(engines.PROFILES)
+    results = benchmark.benchmark(
+        app, profiles, players, seconds, postgresql_uri)
+    for result in results:
+        print(result)
+    for name in sorted(set(profiles) - {x.profile for x in results}):
+        print(f'{name:<12} skipped, needs --postgresql-uri')
+
+
+@app.cli.command('replay-traffic')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--speed', type=float, default=1,
+              help='How many times faster than recorded to replay.')
+def replay_traffic(paths, speed):
+    """Replays recorded requests on a copy of the database."""
+    records = traffic.load_trace(paths)
+    try:
+        result = traffic.replay(app, records, speed)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(result)
+
+
 if __name__ == '__main__':
     with app.app_context():
         if not os.path.exists(migrations_dir):
             model.setup()
-        else:
-            migrate()
-            upgrade()
+        elif model.upgrade_if_changed():
+            print('Database upgraded.')
+        assets.build()
+    warmup.warm_up(app)
     app.run(debug=True)
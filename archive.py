@@ -0,0 +1,195 @@
+import contextlib
+import datetime as dt
+import gzip
+import json
+import os
+import typing
+
+import sqlalchemy as sa
+from flask import current_app
+
+import model
+
+
+# Version of the archive file format.
+ARCHIVE_VERSION = 1
+
+
+def archive_path(quiz_id: int) -> str:
+    directory = current_app.config.get('ARCHIVE_DIRECTORY', 'data/archive')
+    return os.path.join(directory, f'quiz-{quiz_id}.json.gz')
+
+
+def _quiz_storage(quiz: model.Quiz) -> typing.ContextManager:
+    """Selects the shard of the quiz if its fills are stored in one."""
+    shards = current_app.extensions.get('shards')
+    if shards is not None and shards.is_sharded(quiz.id):
+        return shards.using(quiz.id)
+    return contextlib.nullcontext()
+
+
+def claim_quiz(quiz: model.Quiz, now: dt.datetime) -> bool:
+    """Marks the quiz archived unless another process did so already.
+
+    :return: If the quiz was claimed by this call.
+    """
+    table = model.Quiz.__table__
+    result = model.db.session.execute(
+        table.update()
+        .where(table.c.id == quiz.id)
+        .where(table.c.archived_utc.is_(None))
+        .values(archived_utc=now))
+    model.db.session.commit()
+    return result.rowcount == 1
+
+
+def archive_quiz(quiz: model.Quiz) -> typing.Optional[int]:
+    """Moves the fills and answers of a quiz into its archive file.
+
+    The quiz is claimed first by setting its `archived_utc`, so of the
+    workers and commands archiving at the same time only one proceeds.
+    The fills, their answers and finished blocks are written to a gzipped
+    JSON file with the points of every answer, the final points of the
+    players are kept in `QuizResult`, and the rows are deleted. An
+    existing archive is never replaced by one without fills. If archiving
+    fails the claim is released again.
+
+    :return: Number of fills archived, None if the quiz was claimed
+        already.
+    """
+    if not claim_quiz(quiz, dt.datetime.utcnow()):
+        return None
+    try:
+        return _archive_fills(quiz)
+    except Exception:
+        model.db.session.rollback()
+        table = model.Quiz.__table__
+        model.db.session.execute(
+            table.update().where(table.c.id == quiz.id)
+            .values(archived_utc=None))
+        model.db.session.commit()
+        raise
+
+
+def _archive_fills(quiz: model.Quiz) -> int:
+    fill = model.FilledQuiz.__table__
+    answer = model.Answer.__table__
+    done = model.FilledQuiz.finished_blocks.property.secondary
+    choice = model.Choice.__table__
+
+    with _quiz_storage(quiz):
+        fill_ids = sa.select([fill.c.id]).where(fill.c.quiz_id == quiz.id)
+        fills = {}
+        started = {}
+        for row in model.db.session.execute(
+                sa.select([fill.c.id, fill.c.user_id, fill.c.started_utc])
+                .where(fill.c.quiz_id == quiz.id)
+                .order_by(fill.c.id)):
+            started[row.id] = row.started_utc
+            fills[row.id] = {
+                'user_id': row.user_id,
+                'started_utc': row.started_utc and row.started_utc.isoformat(),
+                'finished_blocks': [],
+                'answers': [],
+                'points': 0
+            }
+
+        for fill_id, block_id in model.db.session.execute(
+                sa.select([done.c.quiz_id, done.c.block_id])
+                .where(done.c.quiz_id.in_(fill_ids))):
+            fills[fill_id]['finished_blocks'].append(block_id)
+
+        keys = model.answer_keys(quiz)
+        values = {x.id: x.value for x in model.db.session.execute(
+            sa.select([choice.c.id, choice.c.value])
+            .where(choice.c.question_id.in_(list(keys))))}
+        for row in model.db.session.execute(
+                sa.select([answer.c.quiz_id, answer.c.question_id,
+                           answer.c.text, answer.c.choice_id])
+                .where(answer.c.quiz_id.in_(fill_ids))
+                .order_by(answer.c.id)):
+            key = keys.get(row.question_id)
+            points = key.score(row.text, row.choice_id) if key else 0
+            data = fills[row.quiz_id]
+            data['answers'].append({
+                'question_id': row.question_id,
+                'text': row.text,
+                'choice_id': row.choice_id,
+                'value': values.get(row.choice_id, row.text),
+                'points': model.int_or_float(points)
+            })
+            data['points'] += points
+        for data in fills.values():
+            data['points'] = model.int_or_float(data['points'])
+
+        path = archive_path(quiz.id)
+        if not fills and os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(f'{path}.tmp', 'wt', encoding='utf-8') as f:
+            json.dump({
+                'version': ARCHIVE_VERSION,
+                'quiz': {
+                    'id': quiz.id,
+                    'name': quiz.name,
+                    'start_time_utc': quiz.start_time_utc
+                    and quiz.start_time_utc.isoformat()
+                },
+                'fills': list(fills.values())
+            }, f)
+        os.replace(f'{path}.tmp', path)
+
+        if fills:
+            model.db.session.execute(model.QuizResult.__table__.insert(), [{
+                'quiz_id': quiz.id,
+                'user_id': x['user_id'],
+                'points': x['points'],
+                'started_utc': started[fill_id]
+            } for fill_id, x in fills.items()])
+
+        model.db.session.execute(
+            answer.delete().where(answer.c.quiz_id.in_(fill_ids)))
+        model.db.session.execute(
+            done.delete().where(done.c.quiz_id.in_(fill_ids)))
+        model.db.session.execute(
+            fill.delete().where(fill.c.quiz_id == quiz.id))
+        model.db.session.commit()
+
+    return len(fills)
+
+
+def quiz_end_utc(quiz: model.Quiz) -> typing.Optional[dt.datetime]:
+    """Returns when the last block of the quiz ends, None if not scheduled."""
+    if quiz.start_time_utc is None:
+        return None
+    blocks = model.quiz_timeline(quiz).blocks
+    end = blocks[-1].end if blocks else 0
+    return quiz.start_time_utc + dt.timedelta(seconds=end)
+
+
+def archive_finished(days: int) -> typing.List[model.Quiz]:
+    """Archives the quizzes whose last block ended more than days ago.
+
+    :return: The quizzes archived by this call.
+    """
+    before = dt.datetime.utcnow() - dt.timedelta(days=days)
+    quizzes = model.Quiz.query\
+        .filter(model.Quiz.archived_utc.is_(None))\
+        .filter(model.Quiz.start_time_utc < before)\
+        .order_by(model.Quiz.start_time_utc).all()
+
+    archived = []
+    for quiz in quizzes:
+        if quiz_end_utc(quiz) < before \
+                and archive_quiz(quiz) is not None:
+            archived.append(quiz)
+    return archived
+
+
+def load_archive(quiz_id: int) -> typing.Optional[dict]:
+    """Returns the archived fills of a quiz, None if it has no archive."""
+    path = archive_path(quiz_id)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,141 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import typing
+
+import flask
+from flask import Flask, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_URL = re.compile(
+    r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]""")
+CSS_URL = re.compile(r"""url\(\s*['"]?(?!data:|https?:|/)([^'")]+)['"]?\s*\)""")
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Assets:
+    """Fingerprinted and precompressed copies of the used static files.
+
+    `build` copies every static file referenced by a template into the
+    build directory with the hash of its content in the name, next to
+    gzip and (if the `brotli` package is installed) brotli variants.
+    Templates get a `url_for` that points static urls at these copies,
+    which are served with far-future immutable cache headers.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.directory = None
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.directory = app.config.get(
+            'ASSETS_DIRECTORY',
+            os.path.join(app.static_folder, 'dist'))
+        self.manifest = self.load_manifest()
+
+        app.add_url_rule(
+            f'{app.static_url_path}/dist/<path:filename>',
+            'assets',
+            self.send)
+        app.jinja_env.globals['url_for'] = self.url_for
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, 'manifest.json')
+
+    def load_manifest(self) -> typing.Dict[str, str]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def used_files(self) -> typing.List[str]:
+        """Returns the static files referenced by the templates."""
+        files = set()
+        templates = os.path.join(self.app.root_path, self.app.template_folder)
+        for root, _dirs, names in os.walk(templates):
+            for name in names:
+                with open(os.path.join(root, name), encoding='utf-8') as f:
+                    files.update(STATIC_URL.findall(f.read()))
+
+        return sorted(x for x in files
+                      if os.path.isfile(os.path.join(self.app.static_folder, x)))
+
+    def _absolute_urls(self, filename: str, data: bytes) -> bytes:
+        """Rewrites relative urls of a stylesheet to static urls."""
+        base = os.path.dirname(filename)
+
+        def replace(match):
+            path = os.path.normpath(os.path.join(base, match.group(1)))
+            return f'url({self.app.static_url_path}/{path})'
+
+        return CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+    def build(self) -> typing.Dict[str, str]:
+        """Builds the fingerprinted files and returns the new manifest."""
+        manifest = {}
+        for filename in self.used_files():
+            with open(os.path.join(self.app.static_folder, filename), 'rb') as f:
+                data = f.read()
+            if filename.endswith('.css'):
+                data = self._absolute_urls(filename, data)
+
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            root, ext = os.path.splitext(filename)
+            target = f'{root}.{digest}{ext}'
+            path = os.path.join(self.directory, target)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, 'wb') as f:
+                f.write(data)
+            with open(f'{path}.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(f'{path}.br', 'wb') as f:
+                    f.write(brotli.compress(data))
+
+            manifest[filename] = target
+
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        self.manifest = manifest
+        return manifest
+
+    def url_for(self, endpoint: str, **values) -> str:
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+            endpoint = 'assets'
+        return flask.url_for(endpoint, **values)
+
+    def send(self, filename: str):
+        mimetype = mimetypes.guess_type(filename)[0]
+        encodings = [('br', '.br'), ('gzip', '.gz')]
+
+        encoding = None
+        for name, suffix in encodings:
+            if name in request.accept_encodings and os.path.exists(
+                    os.path.join(self.directory, filename + suffix)):
+                encoding = name
+                filename += suffix
+                break
+
+        response = send_from_directory(
+            self.directory, filename, mimetype=mimetype, cache_timeout=MAX_AGE)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        return response
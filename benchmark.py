@@ -0,0 +1,203 @@
+import contextlib
+import statistics
+import threading
+import time
+import typing
+
+import flask
+import sqlalchemy as sa
+from flask import Flask
+
+import diagnostics
+import engines
+import model
+
+
+class BenchmarkResult:
+    """Requests served and failed while running the workload."""
+
+    def __init__(self, profile: str, seconds: float):
+        self.profile = profile
+        self.seconds = seconds
+        self.requests = 0
+        self.errors = 0
+        self.lock_errors = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def add(self, latency: float, ok: bool):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.seconds
+
+    def percentile(self, p: float) -> float:
+        """Returns the pth percentile of the latencies in milliseconds."""
+        if len(self.latencies) < 2:
+            return sum(self.latencies) * 1000
+        return statistics.quantiles(self.latencies, n=100)[int(p) - 1] * 1000
+
+    def __str__(self) -> str:
+        return (f'{self.profile:<12} {self.throughput:8.1f} req/s  '
+                f'p50 {self.percentile(50):7.1f} ms  '
+                f'p95 {self.percentile(95):7.1f} ms  '
+                f'errors {self.errors:5}  locked {self.lock_errors:5}')
+
+
+def create_players(quiz: model.Quiz, players: int) -> typing.List[int]:
+    """Creates players who finished the first block of quiz.
+
+    :return: User ids of the players.
+    """
+    first = quiz.blocks.order_by(model.Block.order_number).first()
+    users = [model.User(username=f'benchmark{i}') for i in range(players)]
+    model.db.session.add_all(users)
+    model.db.session.flush()
+    model.db.session.add_all([model.FilledQuiz(
+        user_id=x.id,
+        quiz_id=quiz.id,
+        started_utc=quiz.start_time_utc,
+        finished_blocks=[first]
+    ) for x in users])
+    model.db.session.commit()
+    return [x.id for x in users]
+
+
+def play(
+        app: Flask,
+        quiz_id: int,
+        questions: int,
+        user_id: int,
+        result: BenchmarkResult,
+        stop: threading.Event):
+    """Plays the second block of the quiz like a player until stopped.
+
+    Every round loads a question page and the pager and saves an answer,
+    every fifth round also loads the results of the first block.
+    """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    n = 0
+    while not stop.is_set():
+        question = n % questions + 1
+        requests = [
+            ('GET', f'/{quiz_id}/2/{question}', None),
+            ('GET', f'/{quiz_id}/pager?active={question}', None),
+            ('POST', f'/{quiz_id}/2/{question}/answer',
+             {'answer': f'Answer {n % 3 + 1}'}),
+        ]
+        if n % 5 == 4:
+            requests.append(('GET', f'/{quiz_id}/1/', None))
+
+        for method, url, data in requests:
+            start = time.perf_counter()
+            response = client.open(url, method=method, json=data)
+            result.add(time.perf_counter() - start,
+                       response.status_code < 400)
+        n += 1
+
+
+@contextlib.contextmanager
+def database(app: Flask, profile: str, uri: str = None):
+    """Points the application at an empty database for the profile.
+
+    A scratch SQLite database is used unless uri is given, whose tables
+    are created and dropped again.
+    """
+    config = {'DATABASE_PROFILE': profile, 'WTF_CSRF_ENABLED': False,
+              'PROPAGATE_EXCEPTIONS': False}
+    previous = {x: app.config.get(x) for x in config}
+    app.config.update(config)
+    try:
+        if uri is None:
+            with diagnostics.scratch_database(app):
+                yield
+        else:
+            original = app.config['SQLALCHEMY_DATABASE_URI']
+            app.config['SQLALCHEMY_DATABASE_URI'] = uri
+            try:
+                with app.app_context():
+                    model.db.create_all()
+                yield
+            finally:
+                with app.app_context():
+                    model.db.session.remove()
+                    model.db.drop_all()
+                    model.db.get_engine().dispose()
+                app.config['SQLALCHEMY_DATABASE_URI'] = original
+    finally:
+        app.config.update(previous)
+
+
+def run_profile(
+        app: Flask,
+        profile: str,
+        players: int,
+        seconds: float,
+        questions: int = 20,
+        uri: str = None) -> BenchmarkResult:
+    """Runs the quiz-night workload on a database set up by profile.
+
+    Every player has its own thread requesting the player pages and
+    saving answers for seconds. Failed requests are counted, and those
+    failing with "database is locked" separately.
+    """
+    result = BenchmarkResult(profile, seconds)
+
+    def count_lock(sender, exception, **extra):
+        if isinstance(exception, sa.exc.OperationalError) \
+                and 'locked' in str(exception):
+            with result.lock:
+                result.lock_errors += 1
+
+    with database(app, profile, uri):
+        with app.app_context():
+            quiz = diagnostics.create_fixture_quiz(2, questions, 4)
+            quiz_id = quiz.id
+            user_ids = create_players(quiz, players)
+
+        stop = threading.Event()
+        threads = [threading.Thread(
+            target=play,
+            args=(app, quiz_id, questions, x, result, stop),
+            daemon=True) for x in user_ids]
+        with flask.got_request_exception.connected_to(count_lock, app):
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+        app.extensions['grader'].drain(30)
+
+    return result
+
+
+def benchmark(
+        app: Flask,
+        profiles: typing.Iterable[str],
+        players: int,
+        seconds: float,
+        postgresql_uri: str = None) -> typing.List[BenchmarkResult]:
+    """Runs the workload with each profile.
+
+    SQLite profiles run on a scratch database, PostgreSQL profiles on
+    the empty database at postgresql_uri and are skipped without it.
+    """
+    results = []
+    for name in profiles:
+        uri = None
+        if engines.PROFILES[name].dialect == 'postgresql':
+            if postgresql_uri is None:
+                continue
+            uri = postgresql_uri
+        results.append(run_profile(app, name, players, seconds, uri=uri))
+    return results
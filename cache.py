@@ -0,0 +1,252 @@
+import abc
+import collections
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import typing
+
+from flask import Flask
+
+
+# Returned by `get` for keys that are not cached.
+MISSING = object()
+
+# Sets between two removals of expired values from the SQLite cache.
+PURGE_INTERVAL = 1000
+
+
+class BaseCache(abc.ABC):
+    """Key-value store of picklable values with optional expiry."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> typing.Any:
+        """Returns the value of key, `MISSING` if it is not cached."""
+
+    @abc.abstractmethod
+    def set(self, key: str, value: typing.Any, timeout: float = None):
+        """Stores value for timeout seconds, forever if not given."""
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+    def get_or_create(
+            self,
+            key: str,
+            factory: typing.Callable[[], typing.Any],
+            timeout: float = None) -> typing.Any:
+        """Returns the value of key, created by factory if it is not cached.
+
+        :param key: Key of the value.
+        :param factory: Function creating the value if it is not cached.
+        :param timeout: Seconds the created value is kept for.
+        """
+        value = self.get(key)
+        if value is MISSING:
+            value = factory()
+            self.set(key, value, timeout)
+        return value
+
+
+class MemoryCache(BaseCache):
+    """Least recently used values in the memory of the process."""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> typing.Any:
+        with self.lock:
+            expires, value = self.values.get(key, (None, MISSING))
+            if expires is not None and expires < time.time():
+                del self.values[key]
+                return MISSING
+            if value is not MISSING:
+                self.values.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: typing.Any, timeout: float = None):
+        expires = None if timeout is None else time.time() + timeout
+        with self.lock:
+            self.values[key] = (expires, value)
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def delete(self, key: str):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class SQLiteCache(BaseCache):
+    """Pickled values in an SQLite database shared by the processes.
+
+    Every thread of every process opens its own connection, the database
+    is in WAL mode, so readers do not wait for writers.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.sets = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)")
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
+
+    def get(self, key: str) -> typing.Any:
+        row = self.connection.execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] is not None and row[1] < time.time():
+            return MISSING
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value: typing.Any, timeout: float = None):
+        expires = None if timeout is None else time.time() + timeout
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) "
+            "VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires))
+
+        self.sets += 1
+        if self.sets % PURGE_INTERVAL == 0:
+            self.connection.execute(
+                "DELETE FROM cache WHERE expires < ?", (time.time(),))
+
+    def delete(self, key: str):
+        self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self.connection.execute("DELETE FROM cache")
+
+
+class RedisCache(BaseCache):
+    """Pickled values in a Redis server, needs the `redis` package."""
+
+    def __init__(self, url: str, prefix: str = 'talajkviz:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str) -> typing.Any:
+        value = self.client.get(self.prefix + key)
+        return MISSING if value is None else pickle.loads(value)
+
+    def set(self, key: str, value: typing.Any, timeout: float = None):
+        self.client.set(
+            self.prefix + key,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            ex=None if timeout is None else max(1, int(timeout)))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+BACKENDS = {
+    'memory': lambda app: None,
+    'sqlite': lambda app: SQLiteCache(
+        app.config.get('CACHE_PATH', 'data/cache/cache.db')),
+    'redis': lambda app: RedisCache(
+        app.config['CACHE_REDIS_URL'],
+        app.config.get('CACHE_KEY_PREFIX', 'talajkviz:')),
+}
+
+
+class Cache(BaseCache):
+    """Cache of the application shared by its worker processes.
+
+    Values are kept in an LRU of `CACHE_LOCAL_SIZE` items in the memory of
+    the process in front of the shared backend chosen by `CACHE_TYPE`:
+    "memory" has no shared backend, "sqlite" uses the database at
+    `CACHE_PATH` and "redis" the server at `CACHE_REDIS_URL`. Keys of
+    values derived from a quiz contain its revision, so an edit saved by
+    any worker makes every worker create and share the new values, the
+    values of older revisions expire after `CACHE_VALUE_SECONDS`.
+    Values read from the shared backend are kept locally for
+    `CACHE_LOCAL_SECONDS`, so a value deleted by another worker is not
+    used for longer than that.
+
+    Failures of the shared backend are logged and treated as misses, the
+    application keeps working without it.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.local = MemoryCache()
+        self.local_seconds = None
+        self.shared = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.local = MemoryCache(app.config.get('CACHE_LOCAL_SIZE', 1024))
+        self.local_seconds = app.config.get('CACHE_LOCAL_SECONDS')
+        cache_type = app.config.get('CACHE_TYPE', 'memory')
+        if cache_type not in BACKENDS:
+            raise ValueError(f'Unknown cache type: {cache_type}')
+        self.shared = BACKENDS[cache_type](app)
+        app.extensions['cache'] = self
+
+    def get(self, key: str) -> typing.Any:
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception:
+                self.app.logger.exception(f'Reading cache key {key} failed')
+            if value is not MISSING:
+                self.local.set(key, value, self.local_seconds)
+        return value
+
+    def set(self, key: str, value: typing.Any, timeout: float = None):
+        self.local.set(key, value, timeout)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, timeout)
+            except Exception:
+                self.app.logger.exception(f'Writing cache key {key} failed')
+
+    def delete(self, key: str):
+        self.local.delete(key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception:
+                self.app.logger.exception(f'Deleting cache key {key} failed')
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
@@ -1,9 +1,72 @@
 class Config:
     SQLALCHEMY_DATABASE_URI = "sqlite:///data/test.db"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection settings from `engines.PROFILES`, None picks the default
+    # profile of the database: "sqlite-wal" or "postgresql".
+    DATABASE_PROFILE = None
+
+    # Directory of per-quiz answer databases, None keeps them in the main one.
+    SHARD_DIRECTORY = None
+
+    # Cache shared by the worker processes: "memory" keeps values in each
+    # process only, "sqlite" shares them in the CACHE_PATH database and
+    # "redis" in the server at CACHE_REDIS_URL.
+    CACHE_TYPE = "sqlite"
+    CACHE_PATH = "data/cache/cache.db"
+    CACHE_REDIS_URL = None
+    CACHE_LOCAL_SIZE = 1024
+    # Seconds a value read from the shared cache is kept in the process.
+    CACHE_LOCAL_SECONDS = 5
+    # Seconds values derived from a quiz revision are kept for.
+    CACHE_VALUE_SECONDS = 86400
+    # Seconds rendered result and pager pages are kept for.
+    CACHE_PAGE_SECONDS = 300
+    # Seconds the id, language and roles of a logged in user are kept for.
+    IDENTITY_CACHE_SECONDS = 60
 
     PER_PAGE = 20
 
+    QUERY_BUDGETS = {
+        'admin.index': 10,
+        'admin.pager': 10,
+        'admin.quiz': 15,
+        'admin.quiz.results': 15,
+        'quiz.edit_view': 15,
+    }
+
+    # Level of the startup and warm-up timings, the default level of the
+    # logger drops the info ones in production.
+    STARTUP_LOG_LEVEL = "WARNING"
+
+    PREWARM_MINUTES = 5
+    PREWARM_POLL_SECONDS = 60
+    # Of the worker processes only the one holding this lease runs jobs.
+    SCHEDULER_LEASE_PATH = "data/scheduler.db"
+
+    # Processes scoring answers started by each worker process of the
+    # server, so the server runs workers * GRADING_WORKERS of them; keep it
+    # at 1 or 2. 0 scores in the request. Storing the points is a second
+    # write transaction after each save, which waits for the database lock
+    # on SQLite.
+    GRADING_WORKERS = 1
+    GRADING_WAIT_SECONDS = 5
+
+    # Days after the end of a quiz when its fills are archived, None
+    # disables the archiving job.
+    ARCHIVE_AFTER_DAYS = 90
+    ARCHIVE_DIRECTORY = "data/archive"
+
+    # Sampling profiler switched on in the admin, its settings and the
+    # stacks of the workers are kept in the directory.
+    PROFILER_DIRECTORY = "data/profile"
+    PROFILER_INTERVAL = 0.005
+    PROFILER_POLL_SECONDS = 5
+
+    # Requests are recorded in the directory while capturing is on, for
+    # replaying them with `flask replay-traffic`.
+    TRAFFIC_CAPTURE = False
+    TRAFFIC_DIRECTORY = "data/traffic"
+
     SECRET_KEY = "secret"
     ENV = "development"
 
@@ -0,0 +1,301 @@
+import contextlib
+import datetime as dt
+import os
+import re
+import tempfile
+import threading
+import typing
+
+import sqlalchemy as sa
+from flask import Flask
+
+import model
+
+
+def create_fixture_quiz(
+        blocks: int,
+        questions: int,
+        choices: int,
+        name: str = None) -> model.Quiz:
+    """Creates a public quiz, its host and a player who answered everything.
+
+    The first block of the quiz is finished by the player, so both the
+    question pages and the results page can be requested.
+
+    :param blocks: Number of blocks.
+    :param questions: Number of questions per block.
+    :param choices: Number of choices per question.
+    :param name: Name of quiz, generated from the size if not given.
+    """
+    if name is None:
+        name = f'Fixture {blocks}x{questions}x{choices}'
+
+    editor = model.Role.query.filter_by(name='editor').first()
+    if editor is None:
+        editor = model.Role(name='editor')
+        model.db.session.add(editor)
+
+    host = model.User(username=f'host{blocks}{questions}', roles=[editor])
+    player = model.User(username=f'player{blocks}{questions}')
+    model.db.session.add_all([host, player])
+    model.db.session.flush()
+
+    quiz = model.Quiz(
+        name=name,
+        public=True,
+        host_id=host.id,
+        start_time_utc=dt.datetime.utcnow() - dt.timedelta(days=1)
+    )
+    model.db.session.add(quiz)
+    model.db.session.flush()
+
+    fill = model.FilledQuiz(
+        user_id=player.id,
+        quiz_id=quiz.id,
+        started_utc=quiz.start_time_utc
+    )
+    model.db.session.add(fill)
+
+    for i in range(1, blocks + 1):
+        block = model.Block(name=f'Block {i}', order_number=i, quiz=quiz)
+        model.db.session.add(block)
+        if i == 1:
+            fill.finished_blocks.append(block)
+
+        for j in range(1, questions + 1):
+            question = model.Question(
+                order_number=j,
+                content=f'<p>Question {i}.{j}</p>',
+                time=10,
+                block=block
+            )
+            model.db.session.add(question)
+
+            for k in range(1, choices + 1):
+                model.db.session.add(model.Choice(
+                    value=f'Answer {k}' if k == 1 else f'Wrong answer {k}',
+                    points=1 if k == 1 else 0,
+                    question=question
+                ))
+
+            model.db.session.add(model.Answer(
+                text='answer 1',
+                quiz=fill,
+                question=question
+            ))
+
+    model.db.session.commit()
+    return quiz
+
+
+@contextlib.contextmanager
+def scratch_database(app: Flask) -> typing.Iterator[str]:
+    """Points the application at an empty temporary SQLite database.
+
+    The tables are created on entering and the file is removed on exit,
+    once the grader stored the points of the saved answers, when the
+    original database is restored.
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    try:
+        with app.app_context():
+            model.db.create_all()
+        yield path
+    finally:
+        grader = app.extensions.get('grader')
+        if grader is not None:
+            grader.drain(app.config.get('GRADING_WAIT_SECONDS', 5))
+        with app.app_context():
+            model.db.session.remove()
+            model.db.get_engine().dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def count_queries(engine: sa.engine.Engine) -> typing.Iterator[list]:
+    """Collects the SQL statements executed on engine inside the block.
+
+    Only the statements of the calling thread are collected, so background
+    jobs like the pre-warming scheduler do not skew the count.
+    """
+    statements = []
+    thread = threading.get_ident()
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if threading.get_ident() == thread:
+            statements.append(statement)
+
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def view_urls(quiz: model.Quiz) -> typing.Dict[str, typing.Tuple[str, int]]:
+    """Returns the key views of quiz with the url and user to request it."""
+    fill = quiz.fills.first()
+    return {
+        'admin.index': ('/', fill.user_id),
+        'admin.pager': (f'/{quiz.id}/pager', fill.user_id),
+        'admin.quiz': (f'/{quiz.id}/2/1', fill.user_id),
+        'admin.quiz.results': (f'/{quiz.id}/1/', fill.user_id),
+        'quiz.edit_view': (f'/quiz/edit/?id={quiz.id}', quiz.host_id),
+    }
+
+
+def measure_views(
+        app: Flask,
+        urls: typing.Dict[str, typing.Tuple[str, int]]) -> typing.Dict[str, int]:
+    """Requests the views and counts their queries.
+
+    Must be called outside of an application context, so every request
+    starts with an empty session like in production.
+
+    :param app: Application to request the views from.
+    :param urls: Url and user id of the views by name, see `view_urls`.
+    """
+    counts = {}
+    client = app.test_client()
+    with app.app_context():
+        engine = model.db.get_engine()
+
+    for name, (url, user_id) in urls.items():
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+        # The first request of a view fills per-process caches.
+        client.get(url)
+        with count_queries(engine) as statements:
+            response = client.get(url)
+
+        if response.status_code != 200:
+            raise RuntimeError(
+                f'{name} returned {response.status_code} for {url}')
+        counts[name] = len(statements)
+
+    return counts
+
+
+def check_query_budgets(app: Flask) -> typing.Tuple[
+        typing.Dict[str, typing.Tuple[int, int]], typing.List[str]]:
+    """Checks that the key views cost a fixed number of queries.
+
+    Every view is requested for a small and a large fixture quiz in a
+    scratch database. A view fails if it exceeds its budget in the
+    `QUERY_BUDGETS` setting or if its query count grows with the quiz.
+
+    :return: Query counts of the small and the large quiz by view name,
+        and the list of failure messages, empty if every view passed.
+    """
+    budgets = app.config.get('QUERY_BUDGETS', {})
+    with scratch_database(app):
+        with app.app_context():
+            small = view_urls(create_fixture_quiz(2, 2, 2))
+            large = view_urls(create_fixture_quiz(10, 10, 4))
+
+        small_counts = measure_views(app, small)
+        large_counts = measure_views(app, large)
+
+    counts = {}
+    failures = []
+    for name, small_count in small_counts.items():
+        large_count = large_counts[name]
+        budget = budgets.get(name)
+        counts[name] = (small_count, large_count)
+
+        if large_count > small_count:
+            failures.append(f'{name} grows with quiz size '
+                            f'({small_count} -> {large_count} queries)')
+        if budget is not None and large_count > budget:
+            failures.append(f'{name} exceeds its budget '
+                            f'({large_count} > {budget} queries)')
+
+    return counts, failures
+
+
+def hot_queries(
+        quiz: model.Quiz) -> typing.Dict[str, typing.Tuple[sa.orm.Query, str]]:
+    """Returns the hot lookups of quiz with the index each should use."""
+    fill = quiz.fills.first()
+    block = quiz.blocks.first()
+    question = block.questions.first()
+    now = dt.datetime.utcnow()
+    return {
+        'answer': (
+            model.Answer.query
+            .filter_by(quiz_id=fill.id, question_id=question.id),
+            'ix_answer_quiz_id_question_id'),
+        'block': (
+            quiz.blocks.filter_by(order_number=1),
+            'ix_block_quiz_id_order_number'),
+        'question': (
+            block.questions.filter_by(order_number=1),
+            'ix_question_block_id_order_number'),
+        'fill': (
+            model.FilledQuiz.query
+            .filter_by(user_id=fill.user_id, quiz_id=quiz.id),
+            # Index of the unique constraint, named by SQLite.
+            'sqlite_autoindex_filled_quiz_1'),
+        'public quizzes': (
+            model.Quiz.query
+            .filter_by(public=True)
+            .order_by(model.Quiz.start_time_utc.desc())
+            .order_by(model.Quiz.id.desc()),
+            'ix_quiz_public_start_time_utc'),
+        'upcoming quizzes': (
+            model.Quiz.query
+            .filter(model.Quiz.public.is_(True))
+            .filter(model.Quiz.start_time_utc > now)
+            .filter(model.Quiz.start_time_utc <= now + dt.timedelta(hours=1))
+            .order_by(model.Quiz.start_time_utc),
+            'ix_quiz_public_start_time_utc'),
+    }
+
+
+def query_plan(query: sa.orm.Query) -> typing.List[str]:
+    """Returns the SQLite query plan of query, one step per item."""
+    engine = model.db.get_engine()
+    compiled = query.statement.compile(dialect=engine.dialect)
+    params = [compiled.params[x] for x in compiled.positiontup]
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f'EXPLAIN QUERY PLAN {compiled}', params)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def check_query_plans(app: Flask) -> typing.Tuple[
+        typing.Dict[str, typing.List[str]], typing.List[str]]:
+    """Checks that the hot lookups use their composite index.
+
+    The lookups are planned by SQLite against a scratch database with a
+    fixture quiz. A lookup fails if it scans a table or does not use the
+    index it is expected to.
+
+    :return: Query plans by lookup name, and the list of failure messages,
+        empty if every lookup passed.
+    """
+    plans = {}
+    failures = []
+    with scratch_database(app):
+        with app.app_context():
+            queries = hot_queries(create_fixture_quiz(2, 2, 2))
+            for name, (query, index) in queries.items():
+                plan = plans[name] = query_plan(query)
+
+                if any(re.match(r'SCAN (TABLE )?\w+$', x) for x in plan):
+                    failures.append(f'{name} scans a table')
+                if not any(f'INDEX {index}' in x for x in plan):
+                    failures.append(f'{name} does not use {index}')
+
+    return plans, failures
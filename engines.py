@@ -0,0 +1,120 @@
+import typing
+
+import sqlalchemy as sa
+
+
+class EngineProfile:
+    """Connection settings of an engine for a kind of database.
+
+    :param dialect: Backend name of the databases the profile is for.
+    :param statements: Executed on every new connection, like pragmas.
+    :param options: Keyword arguments of `sqlalchemy.create_engine`.
+    :param description: Shown in the benchmark report.
+    """
+
+    def __init__(
+            self,
+            dialect: str,
+            statements: typing.Sequence[str] = (),
+            options: dict = None,
+            description: str = ''):
+        self.dialect = dialect
+        self.statements = tuple(statements)
+        self.options = options or {}
+        self.description = description
+
+    def apply(self, url: sa.engine.url.URL, options: dict):
+        """Updates the options of an engine created for url.
+
+        :raise ValueError: If url is not a database of the profile.
+        """
+        if url.get_backend_name() != self.dialect:
+            raise ValueError(f'Engine profile for {self.dialect} databases '
+                             f'used with {url.get_backend_name()}.')
+        for key, value in self.options.items():
+            if key == 'connect_args':
+                options[key] = dict(options.get(key, {}), **value)
+            else:
+                options[key] = value
+
+    def configure(self, engine: sa.engine.Engine):
+        """Runs the statements of the profile on the connections of engine."""
+        if not self.statements:
+            return
+
+        @sa.event.listens_for(engine, 'connect')
+        def set_up_connection(connection, record):
+            cursor = connection.cursor()
+            for statement in self.statements:
+                cursor.execute(statement)
+            cursor.close()
+            connection.commit()
+
+    def create_engine(self, url: str, **options) -> sa.engine.Engine:
+        """Creates an engine for url with the profile applied."""
+        url = sa.engine.url.make_url(url)
+        self.apply(url, options)
+        engine = sa.create_engine(url, **options)
+        self.configure(engine)
+        return engine
+
+
+PROFILES = {
+    'sqlite': EngineProfile(
+        'sqlite',
+        description='Rollback journal, a new connection per checkout'),
+    'sqlite-wal': EngineProfile(
+        'sqlite',
+        statements=[
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA busy_timeout=10000',
+            'PRAGMA mmap_size=268435456',
+            'PRAGMA cache_size=-32000',
+            'PRAGMA temp_store=MEMORY',
+        ],
+        options={
+            'poolclass': sa.pool.QueuePool,
+            'pool_size': 10,
+            'max_overflow': 20,
+            'connect_args': {'check_same_thread': False, 'timeout': 10},
+        },
+        description='WAL journal, readers do not block the writer, '
+                    'pooled connections'),
+    'postgresql': EngineProfile(
+        'postgresql',
+        statements=[
+            'SET statement_timeout = 30000',
+            'SET idle_in_transaction_session_timeout = 60000',
+        ],
+        options={
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+        },
+        description='Pooled connections with statement timeouts'),
+}
+
+# Profiles used for the backends if `DATABASE_PROFILE` is not set.
+DEFAULT_PROFILES = {
+    'sqlite': 'sqlite-wal',
+    'postgresql': 'postgresql',
+}
+
+
+def get_profile(
+        name: typing.Optional[str],
+        url: sa.engine.url.URL) -> EngineProfile:
+    """Returns the profile called name, the default of url if not given.
+
+    :raise ValueError: If there is no such profile.
+    """
+    if name is None:
+        backend = url.get_backend_name()
+        if backend not in DEFAULT_PROFILES:
+            return EngineProfile(backend)
+        name = DEFAULT_PROFILES[backend]
+    if name not in PROFILES:
+        raise ValueError(f'Unknown engine profile: {name}')
+    return PROFILES[name]
@@ -0,0 +1,333 @@
+import datetime as dt
+import gzip
+import io
+import json
+import math
+import typing
+
+import sqlalchemy as sa
+from flask import current_app
+
+import model
+
+
+# Format name and version written in the header line of every package.
+PACKAGE_FORMAT = 'talajkviz-quiz'
+PACKAGE_VERSION = 1
+
+# Exported columns of the rows of a package by row type.
+FIELDS = {
+    'quiz': ('name', 'start_time_utc'),
+    'block': ('order_number', 'name', 'check_time'),
+    'question': ('order_number', 'content', 'show_choices', 'multiple',
+                 'time', 'base_points'),
+    'choice': ('value', 'content', 'points', 'max_levenshtein_distance'),
+}
+
+TABLES = {
+    'quiz': model.Quiz.__table__,
+    'block': model.Block.__table__,
+    'question': model.Question.__table__,
+    'choice': model.Choice.__table__,
+}
+
+# Fields required even though their column is nullable.
+REQUIRED = {('choice', 'value')}
+
+# Rows inserted by one statement.
+BATCH_SIZE = 500
+
+# First two bytes of gzip files.
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_package(
+        file: typing.BinaryIO,
+        mode: str = 'r',
+        compress: bool = None) -> typing.TextIO:
+    """Opens a package file for reading or writing lines of text.
+
+    Packages are read as gzip if they start like one.
+
+    :param file: Binary file of the package.
+    :param mode: "r" or "w".
+    :param compress: Write the package gzipped, by default if the name of
+        file ends in `.gz`.
+    """
+    if compress is None:
+        compress = str(getattr(file, 'name', '')).endswith('.gz')
+    if mode == 'r':
+        start = file.peek(2)[:2] if hasattr(file, 'peek') else b''
+        if not start:
+            start = file.read(2)
+            file.seek(0)
+        if start == GZIP_MAGIC:
+            file = gzip.GzipFile(fileobj=file, mode='rb')
+    elif compress:
+        file = gzip.GzipFile(fileobj=file, mode='wb')
+    return io.TextIOWrapper(file, encoding='utf-8', newline='\n')
+
+
+def _row(row_type: str, values, **refs) -> str:
+    data = {'type': row_type, **refs}
+    for name in FIELDS[row_type]:
+        value = values[name]
+        if isinstance(value, dt.datetime):
+            value = value.isoformat()
+        data[name] = value
+    return json.dumps(data, ensure_ascii=False) + '\n'
+
+
+def export_quiz(quiz: model.Quiz, f: typing.TextIO) -> int:
+    """Writes a quiz with its blocks, questions and choices as a package.
+
+    A package is JSON lines: a header, the quiz, then the blocks, the
+    questions and the choices, each in the order of their parents.
+    Questions and choices reference their parents by the ids they have in
+    the package, which are numbered from 1.
+
+    :return: Number of rows written besides the header.
+    """
+    block = model.Block.__table__
+    question = model.Question.__table__
+    choice = model.Choice.__table__
+
+    f.write(json.dumps({'type': 'package', 'format': PACKAGE_FORMAT,
+                        'version': PACKAGE_VERSION}) + '\n')
+    f.write(_row('quiz', {x: getattr(quiz, x) for x in FIELDS['quiz']}))
+    count = 1
+
+    blocks = {}
+    for row in model.db.session.execute(
+            sa.select([block]).where(block.c.quiz_id == quiz.id)
+            .order_by(block.c.order_number, block.c.id)):
+        blocks[row.id] = len(blocks) + 1
+        f.write(_row('block', row, id=blocks[row.id]))
+    count += len(blocks)
+
+    questions = {}
+    for row in model.db.session.execute(
+            sa.select([question]).where(question.c.block_id.in_(blocks))
+            .order_by(question.c.block_id, question.c.order_number,
+                      question.c.id)):
+        questions[row.id] = len(questions) + 1
+        f.write(_row('question', row, id=questions[row.id],
+                     block=blocks[row.block_id]))
+    count += len(questions)
+
+    for row in model.db.session.execute(
+            sa.select([choice]).where(choice.c.question_id.in_(questions))
+            .order_by(choice.c.question_id, choice.c.id)):
+        f.write(_row('choice', row, question=questions[row.question_id]))
+        count += 1
+    return count
+
+
+class _Level:
+    """Rows of a package level waiting to be inserted in a batch."""
+
+    def __init__(self, table: sa.Table, parent_key: str):
+        self.table = table
+        self.parent_key = parent_key
+        self.rows = []
+        self.refs = []
+        self.ids = {}
+        self.order_numbers = set()
+
+    def add(self, row: dict, ref: int = None):
+        self.rows.append(row)
+        self.refs.append(ref)
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Inserts the waiting rows and maps their package ids to ids."""
+        if not self.rows:
+            return
+        model.db.session.execute(self.table.insert(), self.rows)
+
+        if any(x is not None for x in self.refs):
+            parent = self.table.c[self.parent_key]
+            parents = {x[self.parent_key] for x in self.rows}
+            inserted = dict(
+                ((x[self.parent_key], x.order_number), x.id)
+                for x in model.db.session.execute(
+                    sa.select([self.table.c.id, parent,
+                               self.table.c.order_number])
+                    .where(parent.in_(parents))))
+            for row, ref in zip(self.rows, self.refs):
+                self.ids[ref] = inserted[
+                    (row[self.parent_key], row['order_number'])]
+        self.rows, self.refs = [], []
+
+
+def _value(value: typing.Any, column: sa.Column) -> typing.Any:
+    """Returns a package value as a value of column.
+
+    :raise ValueError: If value does not fit the type of the column.
+    """
+    column_type = column.type
+    if isinstance(column_type, sa.DateTime):
+        if isinstance(value, str):
+            return dt.datetime.fromisoformat(value)
+    elif isinstance(column_type, sa.Boolean):
+        if isinstance(value, bool):
+            return value
+    elif isinstance(column_type, sa.Integer):
+        if type(value) is int and value >= 0:
+            return value
+    elif isinstance(column_type, sa.Float):
+        if type(value) in (int, float) and math.isfinite(value):
+            return value
+    elif isinstance(column_type, sa.String):
+        if isinstance(value, str) and (column_type.length is None
+                                       or len(value) <= column_type.length):
+            return value
+    raise ValueError
+
+
+def _values(
+        data: dict,
+        row_type: str,
+        table: sa.Table,
+        line: int) -> dict:
+    """Returns the column values of a row, defaults for missing ones.
+
+    Values are checked against the types of their columns, integers must
+    not be negative.
+    """
+    values = {}
+    for name in FIELDS[row_type]:
+        column = table.c[name]
+        value = data.get(name)
+        if value is None and column.default is not None:
+            value = column.default.arg
+        if value is None:
+            if not column.nullable or (row_type, name) in REQUIRED:
+                raise ValueError(f'Line {line}: {name} is required.')
+        else:
+            try:
+                value = _value(value, column)
+            except ValueError:
+                raise ValueError(f'Line {line}: invalid {name}.') from None
+        values[name] = value
+
+    order_number = values.get('order_number', 1)
+    if not isinstance(order_number, int) or order_number < 1:
+        raise ValueError(f'Line {line}: invalid order number.')
+    return values
+
+
+def _id(data: dict, line: int) -> typing.Union[int, str, None]:
+    """Returns the package id of a row, None if it has none."""
+    ref = data.get('id')
+    if ref is not None and not isinstance(ref, (int, str)):
+        raise ValueError(f'Line {line}: invalid id {ref!r}.')
+    return ref
+
+
+def _ref(data: dict, key: str, ids: typing.Container, line: int) -> int:
+    """Returns the package id of the parent a row refers to by key."""
+    ref = data.get(key)
+    if not isinstance(ref, (int, str)) or ref not in ids:
+        raise ValueError(f'Line {line}: unknown {key} {ref!r}.')
+    return ref
+
+
+def import_quiz(
+        f: typing.Iterable[str],
+        host_id: int,
+        name: str = None) -> model.Quiz:
+    """Creates a quiz from a package.
+
+    The package is read line by line and its rows are inserted in batches
+    of `BATCH_SIZE`. Parents must come before their children, package ids
+    must be unique and order numbers must be positive and unique among
+    the children of a parent. The quiz is not public. The session is
+    flushed but not committed.
+
+    :param f: Lines of the package.
+    :param host_id: Host of the created quiz.
+    :param name: Name of the quiz, the name in the package if not given.
+    :raise ValueError: If the package is invalid.
+    """
+    lines = enumerate(f, start=1)
+    try:
+        header = json.loads(next(lines)[1])
+    except (StopIteration, ValueError):
+        raise ValueError('Not a quiz package.')
+    if not isinstance(header, dict) or header.get('format') != PACKAGE_FORMAT:
+        raise ValueError('Not a quiz package.')
+    if header.get('version') != PACKAGE_VERSION:
+        raise ValueError(
+            f'Unsupported package version: {header.get("version")}.')
+
+    quiz = None
+    blocks = _Level(TABLES['block'], 'quiz_id')
+    questions = _Level(TABLES['question'], 'block_id')
+    choices = _Level(TABLES['choice'], 'question_id')
+    block_refs, question_refs = set(), set()
+
+    for line, text in lines:
+        if not text.strip():
+            continue
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise ValueError(f'Line {line}: invalid JSON.')
+        row_type = data.get('type') if isinstance(data, dict) else None
+        if row_type not in FIELDS:
+            raise ValueError(f'Line {line}: unknown row type {row_type!r}.')
+        if (row_type == 'quiz') != (quiz is None):
+            raise ValueError(f'Line {line}: the quiz must come first, once.')
+        values = _values(data, row_type, TABLES[row_type], line)
+
+        if row_type == 'quiz':
+            quiz = model.Quiz(
+                name=model.free_quiz_name(name or values['name'] or ''),
+                start_time_utc=values['start_time_utc'],
+                public=False,
+                host_id=host_id)
+            model.db.session.add(quiz)
+            model.db.session.flush()
+
+        elif row_type == 'block':
+            ref = _id(data, line)
+            if ref in block_refs:
+                raise ValueError(f'Line {line}: duplicate block {ref!r}.')
+            if values['order_number'] in blocks.order_numbers:
+                raise ValueError(f'Line {line}: duplicate order number.')
+            if ref is not None:
+                block_refs.add(ref)
+            blocks.order_numbers.add(values['order_number'])
+            blocks.add(dict(values, quiz_id=quiz.id), ref)
+
+        elif row_type == 'question':
+            block = _ref(data, 'block', block_refs, line)
+            ref = _id(data, line)
+            if ref in question_refs:
+                raise ValueError(f'Line {line}: duplicate question {ref!r}.')
+            if (block, values['order_number']) in questions.order_numbers:
+                raise ValueError(f'Line {line}: duplicate order number.')
+            if ref is not None:
+                question_refs.add(ref)
+            questions.order_numbers.add((block, values['order_number']))
+            if block not in blocks.ids:
+                blocks.flush()
+            questions.add(dict(values, block_id=blocks.ids[block]), ref)
+
+        else:
+            question = _ref(data, 'question', question_refs, line)
+            if question not in questions.ids:
+                questions.flush()
+            choices.add(dict(values, question_id=questions.ids[question]))
+
+    if quiz is None:
+        raise ValueError('The package has no quiz.')
+    for level in (blocks, questions, choices):
+        level.flush()
+
+    search = current_app.extensions.get('search')
+    if search is not None:
+        search.index_quiz(quiz)
+    return quiz
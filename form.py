@@ -8,6 +8,8 @@ from flask_admin.contrib.sqla.fields import QuerySelectField, \
 from flask_admin.form.fields import DateTimeField
 from flask_babelex import lazy_gettext as _l
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
+from werkzeug.datastructures import MultiDict
 
 import model
 
@@ -147,6 +149,32 @@ class EditorForm(FlaskForm):
                 continue
             field.data = getattr(self.model, field.name)
 
+    def load_json(self, data: dict):
+        """Processes JSON data on top of the values of the model.
+
+        Fields missing from data keep the current value of the model, so
+        a request only has to send the fields it changes.
+        """
+        formdata = MultiDict()
+        # noinspection PyTypeChecker
+        for field in self:
+            if isinstance(field, wtf.SubmitField):
+                continue
+            if field.name in data:
+                value = data[field.name]
+            elif isinstance(field, wtf.HiddenField):
+                continue
+            else:
+                value = getattr(self.model, field.name)
+
+            if value is None or value is False:
+                continue
+            if value is True:
+                value = 'y'
+            formdata.add(field.name, str(value))
+
+        self.process(formdata)
+
     def save_model(self):
         # noinspection PyTypeChecker
         for field in self:
@@ -171,6 +199,14 @@ class QuizEditorForm(EditorForm):
         if quiz is None:
             quiz = model.Quiz()
         super().__init__(quiz, *args, **kwargs)
+        self._tree = None
+
+    @property
+    def tree(self) -> model.QuizTree:
+        """Preloaded blocks, questions and choices of the edited quiz."""
+        if self._tree is None:
+            self._tree = model.QuizTree(self.model)
+        return self._tree
 
 
 class BlockEditorForm(EditorForm):
@@ -277,3 +313,41 @@ class ChoiceEditorForm(EditorForm):
             else:
                 choice = model.Choice(question_id=question.id)
         super().__init__(choice, *args, **kwargs)
+
+
+class ClusterForm(FlaskForm):
+    """Accepts a cluster of text answers as a new choice."""
+    value = wtf.HiddenField(
+        validators=[wtf.validators.DataRequired(),
+                    wtf.validators.Length(max=255)])
+    points = wtf.FloatField(
+        _l('Points'),
+        default=1,
+        validators=[wtf.validators.InputRequired()])
+
+
+class PackageForm(FlaskForm):
+    """Uploads a quiz package to import."""
+    package = FileField(
+        _l('Package'),
+        validators=[FileRequired()])
+    name = wtf.StringField(
+        _l('Name'),
+        validators=[wtf.validators.Optional(),
+                    wtf.validators.Length(max=80)])
+    submit = wtf.SubmitField(_l('Import'), render_kw={'class_':'btn btn-success'})
+
+
+class ProfilerForm(FlaskForm):
+    """Settings of the sampling profiler."""
+    enabled = wtf.BooleanField(_l('Enabled'))
+    rate = wtf.FloatField(
+        _l('Sampled Requests'),
+        default=0.1,
+        validators=[wtf.validators.InputRequired(),
+                    wtf.validators.NumberRange(0, 1)])
+    endpoints = wtf.TextAreaField(
+        _l('Endpoints'),
+        validators=[wtf.validators.DataRequired()])
+    submit = wtf.SubmitField(_l('Save'), render_kw={'class_':'btn btn-success'})
+    clear = wtf.SubmitField(_l('Clear'), render_kw={'class_':'btn btn-danger'})
@@ -0,0 +1,205 @@
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import threading
+import typing
+
+import sqlalchemy as sa
+from flask import Flask, current_app, has_app_context
+
+import model
+
+
+# (answer id, question id, text, choice id) of an answer to score.
+AnswerItem = typing.Tuple[int, int, typing.Optional[str], typing.Optional[int]]
+
+
+def score_answers(
+        keys: typing.Dict[int, model.AnswerKey],
+        answers: typing.List[AnswerItem]) -> typing.List[dict]:
+    """Scores answers, runs in a worker process.
+
+    :param keys: Answer keys of the answered questions by question id.
+    :param answers: Answers to score.
+    :return: Values of the answers to store.
+    """
+    return [{
+        'answer_id': answer_id,
+        'answer_text': text,
+        'answer_choice_id': choice_id,
+        'points': keys[question_id].score(text, choice_id)
+    } for answer_id, question_id, text, choice_id in answers]
+
+
+class GradingJob:
+    """Answers of a fill saved in one transaction."""
+
+    def __init__(
+            self,
+            engine: sa.engine.Engine,
+            fill_id: int,
+            revision: int,
+            keys: typing.Dict[int, model.AnswerKey],
+            answers: typing.List[AnswerItem]):
+        self.engine = engine
+        self.fill_id = fill_id
+        self.revision = revision
+        self.keys = keys
+        self.answers = answers
+
+
+class Grader:
+    """Scores answers in worker processes as soon as they are saved.
+
+    Answers added or changed in a transaction are scored after it is
+    committed by a pool of `GRADING_WORKERS` processes (1 if not set, 0
+    scores them in the saving thread), and the points are stored with the
+    revision of the quiz they were given for. Pages showing points use the
+    stored ones while the revision is current.
+
+    Every worker process of the server has its own pool and only knows its
+    own jobs: `wait` blocks until the answers of a fill saved by this
+    process are scored, so the results page of a closing block reads
+    finished scores if the answers were saved by the same process. The
+    page scores answers saved by other processes itself until their points
+    are stored.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.executor = None
+        self.pending = collections.Counter()
+        self.condition = threading.Condition()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        app.extensions['grader'] = self
+        app.before_first_request(self.start)
+
+    def start(self):
+        """Starts the worker processes before the first answers arrive."""
+        executor = self.get_executor()
+        if executor is not None:
+            executor.submit(score_answers, {}, [])
+
+    def get_executor(self) -> typing.Optional[concurrent.futures.Executor]:
+        workers = self.app.config.get('GRADING_WORKERS', 1)
+        if workers == 0:
+            return None
+        with self.condition:
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def submit(self, job: GradingJob):
+        with self.condition:
+            self.pending[job.fill_id] += 1
+
+        executor = self.get_executor()
+        if executor is None:
+            future = concurrent.futures.Future()
+            future.set_result(score_answers(job.keys, job.answers))
+            self.finish(job, future)
+        else:
+            executor.submit(score_answers, job.keys, job.answers)\
+                .add_done_callback(lambda x: self.finish(job, x))
+
+    def finish(self, job: GradingJob, future: concurrent.futures.Future):
+        """Stores the points of a job and marks it done."""
+        try:
+            self.store(job, future.result())
+        except Exception:
+            self.app.logger.exception(
+                f'Grading the answers of fill {job.fill_id} failed')
+        finally:
+            with self.condition:
+                self.pending[job.fill_id] -= 1
+                if not self.pending[job.fill_id]:
+                    del self.pending[job.fill_id]
+                self.condition.notify_all()
+
+    def store(self, job: GradingJob, results: typing.List[dict]):
+        """Stores points of answers that were not changed since."""
+        answer = model.Answer.__table__
+        with job.engine.begin() as connection:
+            connection.execute(
+                answer.update()
+                .where(answer.c.id == sa.bindparam('answer_id'))
+                .where(answer.c.text.isnot_distinct_from(
+                    sa.bindparam('answer_text')))
+                .where(answer.c.choice_id.isnot_distinct_from(
+                    sa.bindparam('answer_choice_id')))
+                .values(scored_points=sa.bindparam('points'),
+                        scored_revision=job.revision),
+                results)
+
+    def wait(self, fill_id: int, timeout: float = None) -> bool:
+        """Waits for the answers of a fill to be scored.
+
+        :return: False if the timeout passed first.
+        """
+        if timeout is None:
+            timeout = self.app.config.get('GRADING_WAIT_SECONDS', 5)
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.pending[fill_id], timeout)
+
+    def drain(self, timeout: float = None) -> bool:
+        """Waits for the answers of every fill to be scored.
+
+        :return: False if the timeout passed first.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending, timeout)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_flush')
+def collect_answers(session: sa.orm.Session, flush_context):
+    """Collects the saved answers to be scored after the commit."""
+    if not has_app_context() or 'grader' not in current_app.extensions:
+        return
+
+    answers = [x for x in itertools.chain(session.new, session.dirty)
+               if isinstance(x, model.Answer) and x not in session.deleted
+               and (x in session.new or session.is_modified(x))]
+    if not answers:
+        return
+
+    fill_ids = {x.quiz_id for x in answers}
+    fills = dict(session.query(model.FilledQuiz.id, model.FilledQuiz.quiz_id)
+                 .filter(model.FilledQuiz.id.in_(fill_ids)))
+    quizzes = {x.id: x for x in session.query(model.Quiz)
+               .filter(model.Quiz.id.in_(set(fills.values())))}
+    engine = session.get_bind(mapper=model.Answer.__mapper__)
+
+    jobs = session.info.setdefault('grading', [])
+    answers.sort(key=lambda x: x.quiz_id)
+    for fill_id, items in itertools.groupby(answers, lambda x: x.quiz_id):
+        quiz = quizzes[fills[fill_id]]
+        keys = model.answer_keys(quiz)
+        items = [(x.id, x.question_id, x.text, x.choice_id) for x in items]
+        jobs.append(GradingJob(
+            engine,
+            fill_id,
+            quiz.revision,
+            {x[1]: keys[x[1]] for x in items},
+            items
+        ))
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_commit')
+def submit_answers(session: sa.orm.Session):
+    jobs = session.info.pop('grading', [])
+    if jobs:
+        grader = current_app.extensions['grader']
+        for job in jobs:
+            grader.submit(job)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_soft_rollback')
+def drop_answers(session: sa.orm.Session, previous_transaction):
+    session.info.pop('grading', None)
@@ -0,0 +1,6 @@
+import warmup
+
+
+def post_worker_init(worker):
+    """Warms up every worker before it accepts requests."""
+    warmup.warm_up(worker.wsgi)
@@ -0,0 +1,107 @@
+import collections
+import typing
+
+from flask import Flask
+from flask_login import UserMixin
+
+import cache
+import model
+
+
+# Stands in for a `model.Role` of a cached user.
+CachedRole = collections.namedtuple('CachedRole', ['name'])
+
+
+class CachedUser(UserMixin):
+    """Current user of a request, loaded from the identity cache.
+
+    Has the attributes of `model.User` the requests read, with the roles
+    as names, so it needs no database access. Like `model.User`, a user
+    with the `admin` role has every role.
+    """
+
+    def __init__(self, id: int, username: str, language: str,
+                 roles: typing.Iterable[str]):
+        self.id = id
+        self.username = username
+        self.language = language
+        self.role_names = frozenset(roles)
+
+    @property
+    def roles(self) -> typing.List[CachedRole]:
+        return [CachedRole(x) for x in sorted(self.role_names)]
+
+    def has_role(self, role: typing.Union[str, model.Role]) -> bool:
+        """Returns `True` if the user identifies with the specified role.
+
+        :param role: A role name or `Role` instance"""
+        name = role if isinstance(role, str) else role.name
+        return 'admin' in self.role_names or name in self.role_names
+
+    def has_any_role(self, *roles: typing.Union[str, model.Role]) -> bool:
+        """Returns if user has any of the given roles.
+
+        Returns True if user has the `admin` role."""
+        return self.has_role('admin') or any(self.has_role(x) for x in roles)
+
+    def has_all_roles(self, *roles: typing.Union[str, model.Role]) -> bool:
+        """Returns if user has all of the given roles.
+
+        Returns True if user has the `admin` role."""
+        return self.has_role('admin') or all(self.has_role(x) for x in roles)
+
+    def __repr__(self) -> str:
+        """String representation of user."""
+        return f'{self.username}'
+
+
+class Identities:
+    """Loads the user of the session from the cache of the application.
+
+    Replaces the user loader of Flask-Security, which queries the user
+    and then its roles on every request. The id, username, language and
+    role names of a user are cached for `IDENTITY_CACHE_SECONDS` instead,
+    and dropped by `invalidate` when the user is edited, so the change
+    reaches every worker within `CACHE_LOCAL_SECONDS`.
+
+    Needs `Security` and `cache.Cache` to be set up first.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        app.extensions['identities'] = self
+        app.login_manager.user_loader(self.load_user)
+
+    @staticmethod
+    def key(user_id: typing.Union[int, str]) -> str:
+        return f'identity:{model.database_key()}:{user_id}'
+
+    def load_user(self, user_id: str) -> typing.Optional[CachedUser]:
+        """Returns the user with id user_id, `None` if there is none."""
+        if not str(user_id).isdigit():
+            return None
+        store = self.app.extensions['cache']
+        key = self.key(user_id)
+        values = store.get(key)
+        if values is cache.MISSING:
+            user = model.User.query.get(int(user_id))
+            if user is None:
+                return None
+            values = {
+                'id': user.id,
+                'username': user.username,
+                'language': user.language,
+                'roles': sorted(x.name for x in user.roles),
+            }
+            store.set(key, values,
+                      self.app.config.get('IDENTITY_CACHE_SECONDS', 60))
+        return CachedUser(**values)
+
+    def invalidate(self, user_id: int):
+        """Drops the cached identity of a user."""
+        self.app.extensions['cache'].delete(self.key(user_id))
@@ -1,16 +1,25 @@
+import bisect
+import collections
 import datetime as dt
+import hashlib
+import itertools
 import pytz
 import typing
 
 import sqlalchemy as sa
+from alembic.script import ScriptDirectory
+from flask import current_app, g, has_app_context
 from sqlalchemy.ext.hybrid import hybrid_property
 from flask_babelex import get_timezone
 from flask_migrate import init, migrate, upgrade
 from flask_security import UserMixin, RoleMixin, current_user
 from flask_security.utils import verify_password, hash_password
-from flask_sqlalchemy import SQLAlchemy, Model
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, Model
 from Levenshtein import distance as str_distance
 
+import cache
+import engines
+
 
 def int_or_float(num: float) -> typing.Union[int, float]:
     if num is None:
@@ -18,6 +27,11 @@ def int_or_float(num: float) -> typing.Union[int, float]:
     return num if num % 1 else int(num)
 
 
+def normalise(text: str) -> str:
+    """Normalises answer text for fuzzy matching."""
+    return text.strip().lower().replace(' ', '')
+
+
 class BaseModel(Model):
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
@@ -51,6 +65,11 @@ class BaseModel(Model):
                 continue
             setattr(self, k, v)
 
+    def to_dict(self) -> dict:
+        """Returns the column values of the model."""
+        return {c.name: getattr(self, c.name)
+                for c in self.__table__.columns}
+
     @classmethod
     def update_or_create(cls, **kwargs):
         pk_name = list(kwargs.keys())[0]
@@ -87,7 +106,62 @@ class BaseModel(Model):
         db.session.commit()
 
 
-db = SQLAlchemy(
+# Tables stored in the database of their quiz if sharding is enabled.
+SHARD_TABLES = {'filled_quiz', 'answer', 'done_blocks'}
+
+
+class ShardedSession(SignallingSession):
+    """Session routing statements on the fills to the current shard.
+
+    The shard of the quiz selected with `Shards.select` is used for every
+    statement that touches one of the `SHARD_TABLES`, everything else
+    goes to the main database.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = None
+        if has_app_context() and 'shards' in current_app.extensions:
+            engine = current_app.extensions['shards'].current_engine()
+
+        if engine is not None:
+            tables = list(mapper.tables) if mapper is not None else []
+            if clause is not None:
+                tables += sa.sql.util.find_tables(
+                    clause, include_aliases=True, include_crud=True)
+            if any(isinstance(x, sa.Table) and x.name in SHARD_TABLES
+                   for x in tables):
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Creates sharded sessions and engines set up by their profile.
+
+    The engine profile is chosen by `DATABASE_PROFILE`, see `engines`.
+    """
+
+    def create_session(self, options):
+        return sa.orm.sessionmaker(class_=ShardedSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Flask-SQLAlchemy 2.5 returns the url and options it changed,
+        # earlier versions change options in place and return None.
+        result = super().apply_driver_hacks(app, sa_url, options)
+        if result is not None:
+            sa_url, options = result
+        profile = app.config.get('DATABASE_PROFILE')
+        engines.get_profile(profile, sa_url).apply(sa_url, options)
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        profile = current_app.config.get('DATABASE_PROFILE')
+        engines.get_profile(profile, sa_url).configure(engine)
+        return engine
+
+
+db = ShardedSQLAlchemy(
     model_class=BaseModel,
     metadata=sa.MetaData(
         naming_convention={
@@ -238,9 +312,17 @@ class User(db.Model, UserMixin):
 
 
 class Quiz(db.Model):
+    __table_args__ = (
+        db.Index('ix_quiz_public_start_time_utc', 'public', 'start_time_utc'),
+        # Cached values are keyed by the id, which must not be reused.
+        {'sqlite_autoincrement': True},
+    )
     name = name_column()
     start_time_utc = db.Column(db.DateTime, index=True)
     public = db.Column(db.Boolean, default=False)
+    revision = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+    archived_utc = db.Column(db.DateTime)
 
     host_id = db.Column(
         db.Integer,
@@ -275,6 +357,9 @@ class Quiz(db.Model):
 
 
 class Block(db.Model):
+    __table_args__ = (
+        db.Index('ix_block_quiz_id_order_number', 'quiz_id', 'order_number'),
+    )
     name = name_column(unique=False, index=False)
     order_number = db.Column(db.Integer, nullable=False, index=True)
     check_time = db.Column(db.Integer, nullable=False, default=120)
@@ -308,6 +393,10 @@ class Block(db.Model):
 
 
 class Question(db.Model):
+    __table_args__ = (
+        db.Index(
+            'ix_question_block_id_order_number', 'block_id', 'order_number'),
+    )
     order_number = db.Column(db.Integer, nullable=False, index=True)
     content = db.Column(db.Text, nullable=False)
     show_choices = db.Column(db.Boolean, default=False)
@@ -374,7 +463,13 @@ class Choice(db.Model):
 
 class FilledQuiz(db.Model):
     __tablenme__ = 'filled_quiz'
+    __table_args__ = (
+        db.UniqueConstraint(
+            'user_id', 'quiz_id', name='uq_filled_quiz_user_id_quiz_id'),
+    )
     started_utc = db.Column(db.DateTime(), default=dt.datetime.utcnow())
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
     user_id = db.Column(
         db.Integer,
         db.ForeignKey("user.id"),
@@ -411,6 +506,25 @@ class FilledQuiz(db.Model):
     def __repr__(self) -> str:
         return f'{self.quiz} / {self.user}'
 
+    @classmethod
+    def get_or_create(cls, user_id: int, quiz_id: int) -> 'FilledQuiz':
+        """Returns the fill of a user, creating it if it does not exist.
+
+        The fill is inserted with a single statement that does nothing if
+        another request created it in the meantime, so concurrent requests
+        at the start of a quiz end up with the same fill.
+        """
+        fill = cls.query.filter_by(user_id=user_id, quiz_id=quiz_id).first()
+        if fill is not None:
+            return fill
+
+        db.session.execute(insert_ignore(cls.__table__).values(
+            user_id=user_id,
+            quiz_id=quiz_id,
+            started_utc=dt.datetime.utcnow()
+        ))
+        return cls.query.filter_by(user_id=user_id, quiz_id=quiz_id).one()
+
     @property
     def started(self) -> dt.datetime:
         if self.started_utc is not None:
@@ -447,12 +561,50 @@ class FilledQuiz(db.Model):
 
     @property
     def available_questions(self):
-        block = self.current_block
-        if block is None:
-            return []
-        return [q for q
-                in block.questions.order_by(Question.order_number)
-                if q.available]
+        return [x.question for x in Pager(self).questions if x.available]
+
+    def save_answer(
+            self,
+            key: 'AnswerKey',
+            text: str = None,
+            choice_ids: typing.Iterable[int] = ()) -> bool:
+        """Stores the answer of the player, replacing the previous one.
+
+        Existing answer rows are reused, so saving again costs one query
+        and an update. An empty answer deletes the rows. Does not commit
+        the session.
+
+        :param key: Answer key of the answered question.
+        :param text: Answer text of a free text question.
+        :param choice_ids: Selected choices of a question with choices.
+        :return: If an answer is stored.
+        """
+        question_id = key.question_id
+        if key.show_choices:
+            values = [{'text': None, 'choice_id': x} for x in choice_ids]
+        elif text:
+            values = [{'text': text, 'choice_id': None}]
+        else:
+            values = []
+
+        answers = Answer.query\
+            .filter_by(quiz_id=self.id, question_id=question_id)\
+            .order_by(Answer.id)\
+            .all()
+        for answer, value in itertools.zip_longest(answers, values):
+            if value is None:
+                db.session.delete(answer)
+            elif answer is None:
+                db.session.add(Answer(
+                    quiz_id=self.id, question_id=question_id, **value))
+            elif (answer.text, answer.choice_id) != \
+                    (value['text'], value['choice_id']):
+                answer.text = value['text']
+                answer.choice_id = value['choice_id']
+                # Scored again, by the results page until the grader is done.
+                answer.scored_points = None
+                answer.scored_revision = None
+        return bool(values)
 
     @property
     def current_question(self):
@@ -461,7 +613,13 @@ class FilledQuiz(db.Model):
 
 
 class Answer(db.Model):
+    __table_args__ = (
+        db.Index('ix_answer_quiz_id_question_id', 'quiz_id', 'question_id'),
+    )
     text = db.Column(db.String(255))
+    # Points given by the grading worker for the quiz revision it used.
+    scored_points = db.Column(db.Float)
+    scored_revision = db.Column(db.Integer)
     choice_id = db.Column(
         db.Integer,
         db.ForeignKey("choice.id"),
@@ -504,30 +662,789 @@ class Answer(db.Model):
 
     @property
     def points(self) -> float:
-        if self.choice:
-            return int_or_float(self.choice.points) or 0
+        return self.score(self.question.choices)
+
+    def score(self, choices: typing.Iterable[Choice]) -> float:
+        """Calculates points of answer.
+
+        :param choices: Choices of the answered question. Passing a
+            preloaded list lets many answers be scored without queries.
+        """
+        return AnswerKey(self.question, choices)\
+            .score(self.text, self.choice_id)
+
+
+class QuizResult(db.Model):
+    """Final points of a player in an archived quiz."""
+    __table_args__ = (
+        db.UniqueConstraint(
+            'quiz_id', 'user_id', name='uq_quiz_result_quiz_id_user_id'),
+    )
+    points = db.Column(db.Float, nullable=False, default=0)
+    started_utc = db.Column(db.DateTime)
+
+    quiz_id = db.Column(
+        db.Integer,
+        db.ForeignKey("quiz.id"),
+        nullable=False,
+        index=True
+    )
+    quiz = db.relationship(
+        "Quiz",
+        backref=db.backref("results", lazy="dynamic", cascade="delete, delete-orphan")
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id"),
+        nullable=False,
+        index=True
+    )
+    user = db.relationship(
+        "User",
+        backref=db.backref("results", lazy="dynamic", cascade="delete, delete-orphan")
+    )
+
+    def __repr__(self) -> str:
+        return f'{self.quiz} / {self.user}'
+
+
+# Cache ------------------------------------------------------------------------
+
+# Used by applications without a `cache.Cache`.
+_cache = cache.MemoryCache()
+
+
+def database_key() -> str:
+    """Returns a short key of the database the application uses."""
+    return hashlib.sha1(str(db.engine.url).encode()).hexdigest()[:8]
+
+
+def cached(name: str, quiz: Quiz, factory: typing.Callable[[], typing.Any]):
+    """Returns a value derived from the structure of a quiz.
+
+    Values are kept in the cache of the application under the current
+    revision of the quiz, any edit of the quiz, its blocks, questions or
+    choices bumps the revision and so invalidates them in every worker.
+    Quiz ids are never reused, so a new quiz can not get the values of a
+    deleted one.
+    They expire after `CACHE_VALUE_SECONDS`, so the values of old
+    revisions do not pile up in the shared cache.
+
+    :param name: Name of the value.
+    :param quiz: Quiz the value belongs to.
+    :param factory: Function creating the value if it is not cached.
+    """
+    store = current_app.extensions.get('cache', _cache)
+    key = f'{name}:{database_key()}:{quiz.id}:{quiz.revision}'
+    timeout = current_app.config.get('CACHE_VALUE_SECONDS', 86400)
+    return store.get_or_create(key, factory, timeout)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_flush')
+def bump_quiz_revision(session: sa.orm.Session, flush_context):
+    """Increments the revision of quizzes whose structure was changed."""
+    quizzes, blocks, questions = set(), set(), set()
+    changed = itertools.chain(
+        session.new,
+        (x for x in session.dirty
+         if session.is_modified(x, include_collections=False)),
+        session.deleted)
+    for obj in changed:
+        if isinstance(obj, Quiz):
+            quizzes.add(obj.id)
+        elif isinstance(obj, Block):
+            quizzes.add(obj.quiz_id)
+        elif isinstance(obj, Question):
+            blocks.add(obj.block_id)
+        elif isinstance(obj, Choice):
+            questions.add(obj.question_id)
+
+    if questions:
+        blocks.update(x for (x,) in session.query(Question.block_id)
+                      .filter(Question.id.in_(questions)))
+    if blocks:
+        quizzes.update(x for (x,) in session.query(Block.quiz_id)
+                       .filter(Block.id.in_(blocks)))
+    quizzes.discard(None)
+    if quizzes:
+        session.execute(
+            Quiz.__table__.update()
+            .where(Quiz.id.in_(quizzes))
+            .values(revision=Quiz.revision + 1))
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_flush')
+def bump_fill_version(session: sa.orm.Session, flush_context):
+    """Increments the version of fills whose answers or blocks changed."""
+    fills = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Answer):
+            fills.add(obj.quiz_id)
+        elif isinstance(obj, FilledQuiz) and obj not in session.new \
+                and session.is_modified(obj):
+            fills.add(obj.id)
+
+    fills.discard(None)
+    if fills:
+        session.execute(
+            FilledQuiz.__table__.update()
+            .where(FilledQuiz.id.in_(fills))
+            .values(version=FilledQuiz.version + 1))
+
+
+# Structure --------------------------------------------------------------------
+
+class AnswerKey:
+    """Choices of a question prepared for scoring answers.
+
+    Holds plain values only, so it can be cached between requests.
+    """
+
+    def __init__(self, question: Question, choices: typing.Iterable[Choice]):
+        self.question_id = question.id
+        self.show_choices = bool(question.show_choices)
+        self.multiple = bool(question.multiple)
+        self.base_points = int_or_float(question.base_points)
+
+        self.points = {}
+        self.wrong = []
+        self.right = []
+        for choice in choices:
+            points = int_or_float(choice.points) or 0
+            self.points[choice.id] = points
+            # Choices without points are never matched against text.
+            if choice.points is None:
+                continue
+            if points > 0:
+                self.right.append((normalise(choice.value), choice.value,
+                                   choice.max_levenshtein_distance, points))
+            else:
+                self.wrong.append((choice.value,
+                                   choice.max_levenshtein_distance, points))
+
+    @property
+    def correct(self) -> typing.List[str]:
+        """Returns the values of the choices worth points."""
+        return [x[1] for x in self.right]
+
+    def score(self, text: str = None, choice_id: int = None) -> float:
+        """Calculates points of an answer.
+
+        Text is first matched against the wrong choices as it is, then
+        against the right ones normalised, the first choice closer than
+        its Levenshtein limit gives the points.
+        """
+        if choice_id is not None:
+            return self.points.get(choice_id, 0)
+
+        if text is not None:
+            for value, d_max, points in self.wrong:
+                if str_distance(value, text) < d_max:
+                    return points
+
+            text = normalise(text)
+            for value, _value, d_max, points in self.right:
+                if str_distance(value, text) < d_max:
+                    return points
+
+        return self.base_points
+
+
+def answer_keys(quiz: Quiz) -> typing.Dict[int, AnswerKey]:
+    """Returns the answer keys of the questions of a quiz by question id."""
+    def load():
+        tree = QuizTree(quiz)
+        return {question.id: AnswerKey(question, tree.choices[question.id])
+                for questions in tree.questions.values()
+                for question in questions}
 
-        for choice in self.question.choices.filter(Choice.points <= 0):
-            d = str_distance(choice.value, self.text)
-            d_max = choice.max_levenshtein_distance
-            if d < d_max:
-                return int_or_float(choice.points) or 0
+    return cached('answer_keys', quiz, load)
 
-        for choice in self.question.choices.filter(Choice.points > 0):
-            value = choice.value.strip().lower().replace(' ', '')
-            text = self.text.strip().lower().replace(' ', '')
-            d = str_distance(value, text)
-            d_max = choice.max_levenshtein_distance
-            if d < d_max:
-                return int_or_float(choice.points) or 0
 
-        return int_or_float(self.question.base_points)
+class AnswerCluster:
+    """Text answers of a question that are the same when normalised."""
+
+    def __init__(self, normalised: str):
+        self.normalised = normalised
+        self.spellings = collections.Counter()
+        self.points = {}
+
+    def add(self, text: str, count: int, points: float):
+        text = text.strip()
+        self.spellings[text] += count
+        self.points[text] = points
+
+    @property
+    def count(self) -> int:
+        return sum(self.spellings.values())
+
+    @property
+    def value(self) -> str:
+        """Returns the most common spelling."""
+        return self.spellings.most_common(1)[0][0]
+
+    @property
+    def score(self) -> float:
+        """Returns the points of the most common spelling."""
+        return self.points[self.value]
+
+    @property
+    def mixed(self) -> bool:
+        """Returns if the spellings are not worth the same points."""
+        return len(set(self.points.values())) > 1
+
+
+def answer_clusters(question: Question) -> typing.List[AnswerCluster]:
+    """Groups the text answers of a question by their normalised text.
+
+    The clusters are ordered by their size, largest first.
+    """
+    key = answer_keys(question.block.quiz)[question.id]
+    rows = db.session.query(Answer.text, sa.func.count(Answer.id))\
+        .filter(Answer.question_id == question.id)\
+        .filter(Answer.text.isnot(None))\
+        .group_by(Answer.text)
+
+    clusters = {}
+    for text, count in rows:
+        normalised = normalise(text)
+        if not normalised:
+            continue
+        if normalised not in clusters:
+            clusters[normalised] = AnswerCluster(normalised)
+        clusters[normalised].add(text, count, key.score(text))
+
+    return sorted(clusters.values(), key=lambda x: (-x.count, x.normalised))
+
+
+class AnswerResult:
+    """Answer of a results page with its points and the correct choices.
+
+    The points stored by the grading worker are used if they were given
+    for the current revision of the quiz, otherwise the answer is scored.
+    """
+
+    def __init__(self, answer: Answer, key: AnswerKey, revision: int = None):
+        self.answer = answer
+        if answer.scored_points is not None \
+                and answer.scored_revision == revision:
+            self.points = int_or_float(answer.scored_points)
+        else:
+            self.points = key.score(answer.text, answer.choice_id)
+        self.correct = key.correct
+
+
+class BlockResults:
+    """Results of a finished block for the answers page.
+
+    Everything the page shows is loaded up front: answers with their
+    questions and choices in one query and the order numbers of the blocks
+    in another, while the choices come from the cached answer keys of the
+    quiz, so rendering the page costs the same number of queries
+    regardless of the quiz size.
+    """
+
+    def __init__(self, fill: FilledQuiz, block: Block):
+        self.block = block
+
+        answers = Answer.query\
+            .join(Question)\
+            .options(
+                db.contains_eager(Answer.question),
+                db.joinedload(Answer.choice))\
+            .filter(Answer.quiz_id == fill.id)\
+            .order_by(Question.order_number, Answer.id)\
+            .all()
+
+        keys = answer_keys(block.quiz)
+        revision = block.quiz.revision
+        results = [AnswerResult(x, keys[x.question_id], revision)
+                   for x in answers]
+        self.answers = [x for x in results
+                        if x.answer.question.block_id == block.id]
+        self.block_points = int_or_float(sum(x.points for x in self.answers))
+        self.total = int_or_float(sum(x.points for x in results))
+
+        order_numbers = [x for (x,) in db.session.query(Block.order_number)
+                         .filter(Block.quiz_id == block.quiz_id)
+                         .order_by(Block.order_number)]
+        previous = [x for x in order_numbers if x < block.order_number]
+        following = [x for x in order_numbers if x > block.order_number]
+        self.prev_block = previous[-1] if previous else None
+        self.next_block = following[0] if following else None
+
+
+class QuizTree:
+    """Blocks, questions and choices of a quiz loaded in two queries.
+
+    Blocks and questions are ordered by their order numbers, choices by
+    their ids. Questions of a block are in `questions[block.id]`, choices
+    of a question in `choices[question.id]`.
+    """
+
+    def __init__(self, quiz: Quiz):
+        self.quiz = quiz
+        self.blocks = []
+        self.questions = {}
+        self.choices = {}
+
+        rows = db.session.query(Block, Question)\
+            .outerjoin(Question, Question.block_id == Block.id)\
+            .filter(Block.quiz_id == quiz.id)\
+            .order_by(Block.order_number, Block.id,
+                      Question.order_number, Question.id)
+        for block, question in rows:
+            if block.id not in self.questions:
+                self.blocks.append(block)
+                self.questions[block.id] = []
+            if question is not None:
+                self.questions[block.id].append(question)
+                self.choices[question.id] = []
+
+        for choice in Choice.query\
+                .join(Question)\
+                .join(Block)\
+                .filter(Block.quiz_id == quiz.id)\
+                .order_by(Choice.id):
+            self.choices[choice.question_id].append(choice)
+
+
+class TimelineQuestion:
+    """Question of the timeline with its unlock offset in seconds."""
+
+    def __init__(self, id: int, order_number: int, offset: int):
+        self.id = id
+        self.order_number = order_number
+        self.offset = offset
+
+
+class TimelineBlock:
+    """Block of the timeline with its start and end offsets in seconds."""
+
+    def __init__(
+            self,
+            id: int,
+            order_number: int,
+            start: int,
+            end: int,
+            questions: typing.List[TimelineQuestion]):
+        self.id = id
+        self.order_number = order_number
+        self.start = start
+        self.end = end
+        self.questions = questions
+
+
+class Timeline:
+    """Unlock times of the questions of a quiz.
+
+    Times are offsets in seconds from the start of the quiz. A question
+    unlocks after every question before it in its block, and a block
+    starts after the questions and the check time of the blocks before it.
+    Holds plain values only, so it can be cached between requests.
+    """
+
+    def __init__(self, tree: QuizTree):
+        self.offsets = {}
+        self.blocks = []
+        self.unlocks = []
+
+        t = 0
+        for block in tree.blocks:
+            start = t
+            questions = []
+            for question in tree.questions[block.id]:
+                self.offsets[question.id] = t
+                questions.append(TimelineQuestion(
+                    question.id, question.order_number, t))
+                t += question.time or 0
+            t += block.check_time or 0
+            self.blocks.append(TimelineBlock(
+                block.id, block.order_number, start, t, questions))
+        self.unlocks = sorted(self.offsets.values())
+
+    def unlock_time(
+            self,
+            question_id: int,
+            start_time_utc: dt.datetime) -> dt.datetime:
+        return start_time_utc + dt.timedelta(seconds=self.offsets[question_id])
+
+    def available(
+            self,
+            question_id: int,
+            start_time_utc: dt.datetime,
+            now: dt.datetime = None) -> bool:
+        if start_time_utc is None:
+            return False
+        if now is None:
+            now = dt.datetime.utcnow()
+        return self.unlock_time(question_id, start_time_utc) < now
+
+    def step(
+            self,
+            start_time_utc: dt.datetime,
+            now: dt.datetime = None) -> int:
+        """Returns the number of questions available at now."""
+        if start_time_utc is None:
+            return 0
+        if now is None:
+            now = dt.datetime.utcnow()
+        elapsed = (now - start_time_utc).total_seconds()
+        return bisect.bisect_left(self.unlocks, elapsed)
+
+    def manifest(self) -> typing.List[dict]:
+        """Returns the blocks with the offsets for the browser.
+
+        Questions are [order number, unlock offset] pairs.
+        """
+        return [{
+            'order_number': block.order_number,
+            'start': block.start,
+            'end': block.end,
+            'questions': [[x.order_number, x.offset] for x in block.questions]
+        } for block in self.blocks]
+
+
+def quiz_timeline(quiz: Quiz) -> Timeline:
+    """Returns the cached timeline of a quiz."""
+    return cached('timeline', quiz, lambda: Timeline(QuizTree(quiz)))
+
+
+class PagerQuestion:
+    """Question of the pager with its state for the player."""
+
+    def __init__(
+            self,
+            question: TimelineQuestion,
+            available: bool,
+            answered: bool):
+        self.id = question.id
+        self.order_number = question.order_number
+        self.available = available
+        self.answered = answered
+
+    @property
+    def question(self) -> Question:
+        return Question.query.get(self.id)
+
+
+class Pager:
+    """Questions of the current block of a fill with their state.
+
+    Costs a constant number of queries: the quiz, the finished blocks and
+    the answered questions of the fill, the structure of the quiz comes
+    from its cached timeline.
+    """
+
+    def __init__(self, fill: FilledQuiz, timeline: Timeline = None):
+        if timeline is None:
+            timeline = quiz_timeline(fill.quiz)
+
+        self.fill = fill
+        self.quiz_id = fill.quiz_id
+        self.timeline = timeline
+
+        finished = {x for (x,) in db.session.query(Block.id)
+                    .join(Block.finished_quizzes)
+                    .filter(FilledQuiz.id == fill.id)}
+        answered = {x for (x,) in db.session.query(Answer.question_id)
+                    .filter(Answer.quiz_id == fill.id)
+                    .distinct()}
+
+        self.block = next(
+            (x for x in timeline.blocks if x.id not in finished), None)
+        self.questions = []
+        if self.block is None:
+            return
+
+        start_time_utc = fill.start_time_utc
+        now = dt.datetime.utcnow()
+        for question in self.block.questions:
+            self.questions.append(PagerQuestion(
+                question,
+                timeline.available(question.id, start_time_utc, now),
+                question.id in answered
+            ))
+
+    @property
+    def finish(self) -> bool:
+        """Returns if every question of the block is answered."""
+        return bool(self.questions) and all(x.answered for x in self.questions)
+
+    def get(self, order_number: int) -> typing.Optional[PagerQuestion]:
+        for item in self.questions:
+            if item.order_number == order_number:
+                return item
+
+
+def insert_ignore(table: sa.Table) -> sa.sql.Insert:
+    """Returns an insert into table that skips rows violating a constraint."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def create_fills(quiz: Quiz) -> int:
+    """Creates the fills of the players of the earlier quizzes of the host.
+
+    :return: Number of fills created.
+    """
+    fill = FilledQuiz.__table__
+    shards = current_app.extensions.get('shards')
+    if shards is not None and shards.is_sharded(quiz.id):
+        earlier = [x for x, in db.session.query(Quiz.id)
+                   .filter(Quiz.host_id == quiz.host_id)
+                   .filter(Quiz.id != quiz.id)]
+        rows = [{
+            'user_id': x,
+            'quiz_id': quiz.id,
+            'started_utc': quiz.start_time_utc
+        } for x in sorted(shards.players(earlier))]
+        if not rows:
+            return 0
+        with shards.using(quiz.id):
+            return db.session.execute(insert_ignore(fill), rows).rowcount
+
+    existing = fill.alias()
+    players = sa.select([
+            fill.c.user_id,
+            sa.literal(quiz.id),
+            sa.literal(quiz.start_time_utc)
+        ])\
+        .select_from(fill.join(Quiz.__table__))\
+        .where(Quiz.host_id == quiz.host_id)\
+        .where(fill.c.quiz_id != quiz.id)\
+        .where(fill.c.user_id.notin_(
+            sa.select([existing.c.user_id])
+            .where(existing.c.quiz_id == quiz.id)))\
+        .distinct()
+
+    result = db.session.execute(insert_ignore(fill).from_select(
+        ['user_id', 'quiz_id', 'started_utc'], players))
+    return result.rowcount
+
+
+def merge_duplicate_fills() -> int:
+    """Merges the fills of the same user and quiz into the oldest one.
+
+    Needed before the unique constraint on the fills can be created.
+    For every question the answers of the fill that answered it last are
+    kept, and the finished blocks of all duplicates are combined.
+
+    :return: Number of fills removed.
+    """
+    tables = sa.inspect(db.get_engine()).get_table_names()
+    if FilledQuiz.__tablename__ not in tables:
+        return 0
+
+    fill = FilledQuiz.__table__
+    done = FilledQuiz.finished_blocks.property.secondary
+    answer = Answer.__table__
+    groups = db.session.execute(
+        sa.select([fill.c.user_id, fill.c.quiz_id])
+        .group_by(fill.c.user_id, fill.c.quiz_id)
+        .having(sa.func.count() > 1)).fetchall()
+
+    removed = 0
+    for user_id, quiz_id in groups:
+        ids = [x for x, in db.session.execute(
+            sa.select([fill.c.id])
+            .where(fill.c.user_id == user_id)
+            .where(fill.c.quiz_id == quiz_id)
+            .order_by(fill.c.id))]
+        keep, duplicates = ids[0], ids[1:]
+
+        latest = {}
+        rows = db.session.execute(
+            sa.select([answer.c.id, answer.c.quiz_id, answer.c.question_id])
+            .where(answer.c.quiz_id.in_(ids))
+            .order_by(answer.c.id))
+        for answer_id, fill_id, question_id in rows:
+            latest[question_id] = fill_id
+        stale = [sa.and_(answer.c.quiz_id != fill_id,
+                         answer.c.question_id == question_id)
+                 for question_id, fill_id in latest.items()]
+        if stale:
+            db.session.execute(answer.delete()
+                               .where(answer.c.quiz_id.in_(ids))
+                               .where(sa.or_(*stale)))
+        db.session.execute(answer.update()
+                           .where(answer.c.quiz_id.in_(duplicates))
+                           .values(quiz_id=keep))
+
+        blocks = {x for x, in db.session.execute(
+            sa.select([done.c.block_id]).where(done.c.quiz_id.in_(ids)))}
+        db.session.execute(done.delete().where(done.c.quiz_id.in_(ids)))
+        if blocks:
+            db.session.execute(done.insert(), [
+                {'quiz_id': keep, 'block_id': x} for x in blocks])
+
+        db.session.execute(fill.delete().where(fill.c.id.in_(duplicates)))
+        removed += len(duplicates)
+
+    db.session.commit()
+    return removed
+
+
+def free_quiz_name(name: str) -> str:
+    """Returns name, or name numbered if a quiz already has it."""
+    length = Quiz.name.property.columns[0].type.length
+    candidate = name[:length]
+    number = 1
+    while db.session.query(Quiz.id).filter_by(name=candidate).first():
+        number += 1
+        suffix = f' ({number})'
+        candidate = name[:length - len(suffix)] + suffix
+    return candidate
+
+
+def _copy_children(
+        table: sa.Table,
+        parent_key: str,
+        parents: sa.sql.Select) -> sa.sql.Select:
+    """Copies the rows of table under the copies of their parents.
+
+    :param table: Table of the copied rows.
+    :param parent_key: Column of table referencing the parent.
+    :param parents: Pairs of parent ids as `old_id` and `new_id`.
+    :return: Pairs of the ids of the copied rows and their copies.
+    """
+    pairs = parents.alias()
+    columns = [x for x in table.c if x.name not in ('id', parent_key)]
+    rows = sa.select(columns + [pairs.c.new_id])\
+        .select_from(table.join(pairs, table.c[parent_key] == pairs.c.old_id))\
+        .order_by(table.c.id)
+    db.session.execute(table.insert().from_select(
+        [x.name for x in columns] + [parent_key], rows))
+
+    def numbered(column):
+        return sa.select([
+                table.c.id,
+                sa.func.row_number().over(order_by=table.c.id).label('n')
+            ])\
+            .where(table.c[parent_key].in_(sa.select([column])))\
+            .alias()
+
+    old, new = numbered(pairs.c.old_id), numbered(pairs.c.new_id)
+    return sa.select([old.c.id.label('old_id'), new.c.id.label('new_id')])\
+        .select_from(old.join(new, old.c.n == new.c.n))
+
+
+def clone_quiz(quiz: Quiz, name: str, host_id: int = None) -> Quiz:
+    """Copies a quiz with its blocks, questions and choices.
+
+    Every level of the tree is copied by one INSERT ... SELECT in the
+    order of the ids, so the n-th copied row of a level is the copy of
+    the n-th original one, which pairs the parents of the next level.
+    The copy is not public and has no start time. The session is flushed
+    but not committed.
+
+    :param quiz: Copied quiz.
+    :param name: Name of the copy.
+    :param host_id: Host of the copy, the host of quiz if not given.
+    """
+    copy = Quiz(
+        name=name,
+        public=False,
+        host_id=quiz.host_id if host_id is None else host_id)
+    db.session.add(copy)
+    db.session.flush()
+
+    quizzes = sa.select([sa.literal(quiz.id).label('old_id'),
+                         sa.literal(copy.id).label('new_id')])
+    blocks = _copy_children(Block.__table__, 'quiz_id', quizzes)
+    questions = _copy_children(Question.__table__, 'block_id', blocks)
+    _copy_children(Choice.__table__, 'question_id', questions)
+
+    search = current_app.extensions.get('search')
+    if search is not None:
+        search.index_quiz(copy)
+    return copy
+
+
+# Tables in the database that are not managed by the migrations.
+UNMANAGED_TABLES = {
+    'schema_fingerprint',
+    # Full-text index of the search module and its FTS5 shadow tables.
+    'search_index',
+    'search_index_data',
+    'search_index_idx',
+    'search_index_content',
+    'search_index_docsize',
+    'search_index_config',
+}
+
+
+def include_object(obj, name, type_, reflected, compare_to) -> bool:
+    """Keeps unmanaged tables out of autogenerated migrations."""
+    return not (type_ == 'table' and reflected and name in UNMANAGED_TABLES)
+
+
+def schema_fingerprint() -> str:
+    """Returns a hash of the model tables and the migration heads."""
+    dialect = db.get_engine().dialect
+    ddl = []
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(sa.schema.CreateTable(table).compile(dialect=dialect)))
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            ddl.append(str(sa.schema.CreateIndex(index).compile(dialect=dialect)))
+
+    config = current_app.extensions['migrate'].migrate.get_config()
+    heads = ScriptDirectory.from_config(config).get_heads()
+    ddl.extend(sorted(heads))
+
+    return hashlib.sha256('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+
+def stored_schema_fingerprint() -> typing.Optional[str]:
+    db.session.execute(
+        'CREATE TABLE IF NOT EXISTS schema_fingerprint '
+        '(fingerprint VARCHAR(64) NOT NULL)')
+    return db.session.execute(
+        'SELECT fingerprint FROM schema_fingerprint').scalar()
+
+
+def store_schema_fingerprint(fingerprint: str = None):
+    if fingerprint is None:
+        fingerprint = schema_fingerprint()
+    stored_schema_fingerprint()
+    db.session.execute('DELETE FROM schema_fingerprint')
+    db.session.execute(
+        'INSERT INTO schema_fingerprint (fingerprint) VALUES (:fingerprint)',
+        {'fingerprint': fingerprint})
+    db.session.commit()
+
+
+def upgrade_if_changed() -> bool:
+    """Upgrades the database if the models or migrations have changed.
+
+    Compares the schema fingerprint stored at the last upgrade with the
+    current one, so an unchanged deployment starts without loading the
+    migration environment. New migrations are not generated here, that
+    is done explicitly with `flask db migrate`.
+
+    :return: True if the upgrade was run.
+    """
+    fingerprint = schema_fingerprint()
+    if stored_schema_fingerprint() == fingerprint:
+        return False
+
+    merge_duplicate_fills()
+    upgrade()
+    store_schema_fingerprint(fingerprint)
+    return True
 
 
 def setup():
     init()
     migrate()
     upgrade()
+    store_schema_fingerprint()
 
     print("Creating roles...")
     Role.from_csv()
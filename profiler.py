@@ -0,0 +1,221 @@
+import collections
+import fnmatch
+import glob
+import json
+import os
+import random
+import sys
+import threading
+import time
+import typing
+import uuid
+
+from flask import Flask, request
+
+
+# Endpoints profiled by default, the lists of the model views included.
+DEFAULT_ENDPOINTS = ('admin.pager', 'admin.quiz', 'admin.form', '*.index_view')
+
+
+def frame_name(frame) -> str:
+    return f'{frame.f_globals.get("__name__", "?")}.{frame.f_code.co_name}'
+
+
+def read_stacks(path: str) -> collections.Counter:
+    """Reads collapsed stacks, one "frame;frame;... count" per line."""
+    stacks = collections.Counter()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def write_stacks(path: str, stacks: typing.Mapping[str, int]):
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{stack} {count}\n')
+    os.replace(f'{path}.tmp', path)
+
+
+class Profiler:
+    """Sampling profiler of live requests, switched on from the admin.
+
+    While enabled, a `rate` fraction of the requests of the matching
+    endpoints is sampled: a daemon thread records the stacks of the
+    threads serving them every `PROFILER_INTERVAL` seconds. The stacks of
+    every worker are written to `PROFILER_DIRECTORY` in collapsed format,
+    where the settings are also kept, so switching it in one worker
+    switches it in all of them within `PROFILER_POLL_SECONDS`.
+
+    When disabled a request costs one clock reading, and a stat of the
+    settings file every poll interval.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.directory = None
+        self.settings = {'enabled': False, 'rate': 0.1,
+                         'endpoints': list(DEFAULT_ENDPOINTS), 'session': ''}
+        self.settings_mtime = None
+        self.checked = 0
+        self.active = {}
+        self.stacks = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.directory = app.config.get('PROFILER_DIRECTORY', 'data/profile')
+        app.extensions['profiler'] = self
+        app.before_request(self.start_request)
+        app.teardown_request(self.end_request)
+
+    @property
+    def settings_path(self) -> str:
+        return os.path.join(self.directory, 'settings.json')
+
+    @property
+    def stacks_path(self) -> str:
+        return os.path.join(
+            self.directory,
+            f'stacks-{self.settings["session"]}-{os.getpid()}.txt')
+
+    def refresh(self):
+        """Reloads the settings if their file changed."""
+        now = time.monotonic()
+        poll = self.app.config.get('PROFILER_POLL_SECONDS', 5)
+        if now - self.checked < poll:
+            return
+        self.checked = now
+
+        try:
+            mtime = os.stat(self.settings_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.settings_mtime:
+            return
+
+        settings = dict(self.settings, enabled=False)
+        if mtime is not None:
+            with open(self.settings_path, encoding='utf-8') as f:
+                settings.update(json.load(f))
+        with self.lock:
+            if settings['session'] != self.settings['session']:
+                self.stacks.clear()
+            self.settings = settings
+            self.settings_mtime = mtime
+        if settings['enabled']:
+            self.start_sampler()
+
+    def configure(self, enabled: bool, rate: float,
+                  endpoints: typing.List[str]):
+        """Stores new settings for every worker."""
+        self.save_settings(dict(self.settings, enabled=enabled, rate=rate,
+                                endpoints=endpoints))
+
+    def clear(self):
+        """Drops the stacks recorded so far by every worker."""
+        for path in glob.glob(os.path.join(self.directory, 'stacks-*.txt')):
+            os.remove(path)
+        self.save_settings(dict(self.settings, session=uuid.uuid4().hex))
+
+    def save_settings(self, settings: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f'{self.settings_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(settings, f)
+        os.replace(f'{self.settings_path}.tmp', self.settings_path)
+        self.checked = 0
+        self.refresh()
+
+    def profiles(self, endpoint: str) -> bool:
+        """Returns if a request of endpoint is to be sampled."""
+        return any(fnmatch.fnmatchcase(endpoint, x)
+                   for x in self.settings['endpoints']) \
+            and random.random() < self.settings['rate']
+
+    def start_request(self):
+        self.refresh()
+        if self.settings['enabled'] and request.endpoint \
+                and self.profiles(request.endpoint):
+            self.active[threading.get_ident()] = request.endpoint
+
+    def end_request(self, exception=None):
+        if self.active:
+            self.active.pop(threading.get_ident(), None)
+
+    def start_sampler(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        interval = self.app.config.get('PROFILER_INTERVAL', 0.005)
+        flush_interval = self.app.config.get('PROFILER_POLL_SECONDS', 5)
+        flushed = time.monotonic()
+        while self.settings['enabled']:
+            time.sleep(interval)
+            self.sample()
+            if time.monotonic() - flushed > flush_interval:
+                self.flush()
+                flushed = time.monotonic()
+                self.refresh()
+        self.flush()
+
+    def sample(self):
+        """Records the stacks of the threads serving sampled requests."""
+        frames = sys._current_frames()
+        for ident, endpoint in list(self.active.items()):
+            frame = frames.get(ident)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            if names:
+                names.append(endpoint)
+                with self.lock:
+                    self.stacks[';'.join(reversed(names))] += 1
+
+    def flush(self):
+        """Writes the stacks of this worker into the directory."""
+        with self.lock:
+            stacks = dict(self.stacks)
+        if stacks:
+            os.makedirs(self.directory, exist_ok=True)
+            write_stacks(self.stacks_path, stacks)
+
+    def collect(self) -> collections.Counter:
+        """Returns the stacks recorded by every worker."""
+        self.flush()
+        stacks = collections.Counter()
+        pattern = f'stacks-{self.settings["session"]}-*.txt'
+        for path in glob.glob(os.path.join(self.directory, pattern)):
+            try:
+                stacks.update(read_stacks(path))
+            except OSError:
+                pass
+        return stacks
+
+
+def top_functions(
+        stacks: typing.Mapping[str, int],
+        limit: int = 30) -> typing.List[typing.Tuple[str, int, int]]:
+    """Returns the functions with the most samples.
+
+    :return: Name, samples in the function itself and samples in it or
+        the functions it called, ordered by the latter.
+    """
+    own = collections.Counter()
+    total = collections.Counter()
+    for stack, count in stacks.items():
+        names = stack.split(';')
+        own[names[-1]] += count
+        for name in set(names[1:]):
+            total[name] += count
+    return [(name, own[name], count)
+            for name, count in total.most_common(limit)]
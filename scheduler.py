@@ -0,0 +1,186 @@
+import datetime as dt
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import Flask
+
+import archive
+import model
+import warmup
+
+
+# Time between two runs of the archiving job.
+ARCHIVE_INTERVAL = dt.timedelta(days=1)
+
+
+class Lease:
+    """Lease of a name held by one process at a time.
+
+    Kept in an SQLite database shared by the processes of a host. The
+    holder has to renew it before it expires, otherwise another process
+    can take it over.
+
+    :param path: Path of the database.
+    :param name: Name of the lease.
+    """
+
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def acquire(self, seconds: float) -> bool:
+        """Takes or renews the lease for seconds.
+
+        :return: If this process holds the lease.
+        """
+        now = time.time()
+        connection = sqlite3.connect(
+            self.path, timeout=10, isolation_level=None)
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS lease ("
+                "name TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+                "expires REAL NOT NULL)")
+            connection.execute(
+                "INSERT OR IGNORE INTO lease (name, owner, expires) "
+                "VALUES (?, ?, 0)", (self.name, self.owner))
+            cursor = connection.execute(
+                "UPDATE lease SET owner = ?, expires = ? "
+                "WHERE name = ? AND (owner = ? OR expires < ?)",
+                (self.owner, now + seconds, self.name, self.owner, now))
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+
+class Scheduler:
+    """In-process scheduler of the background jobs.
+
+    A daemon thread sleeps until `PREWARM_MINUTES` before the start of the
+    next public quiz and runs `warmup.prewarm_quiz` for it. The upcoming
+    quizzes are looked up again at least every `PREWARM_POLL_SECONDS`, so
+    new quizzes and changed start times are picked up.
+
+    Once a day the quizzes that ended more than `ARCHIVE_AFTER_DAYS` ago
+    are archived with `archive.archive_finished`.
+
+    Every worker starts the thread, but only the one holding the lease in
+    `SCHEDULER_LEASE_PATH` runs the jobs. The others check the lease every
+    poll interval and take over if the holder stops renewing it.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.thread = None
+        self.warmed = set()
+        self.archived_at = None
+        self.lease = None
+        self.wake_up = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.lease = Lease(
+            app.config.get('SCHEDULER_LEASE_PATH', 'data/scheduler.db'),
+            'scheduler')
+        app.before_first_request(self.start)
+
+    @property
+    def lead_time(self) -> dt.timedelta:
+        return dt.timedelta(minutes=self.app.config.get('PREWARM_MINUTES', 5))
+
+    @property
+    def poll_interval(self) -> float:
+        return self.app.config.get('PREWARM_POLL_SECONDS', 60)
+
+    def start(self):
+        if self.thread or not (self.app.config.get('PREWARM_MINUTES')
+                               or self.app.config.get('ARCHIVE_AFTER_DAYS')):
+            return
+        self.thread = threading.Thread(
+            target=self.run, name='prewarm', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                leader = self.lease.acquire(self.poll_interval * 3)
+            except sqlite3.Error:
+                self.app.logger.exception('Taking the scheduler lease failed')
+                leader = False
+            if not leader:
+                self.wake_up.wait(self.poll_interval)
+                self.wake_up.clear()
+                continue
+
+            with self.app.app_context():
+                try:
+                    timeout = self.tick()
+                except Exception:
+                    self.app.logger.exception('Pre-warming quizzes failed')
+                    timeout = self.poll_interval
+                finally:
+                    model.db.session.remove()
+            self.wake_up.wait(timeout)
+            self.wake_up.clear()
+
+    def tick(self) -> float:
+        """Runs the jobs that are due.
+
+        :return: Seconds until the next quiz is due or the next poll.
+        """
+        now = dt.datetime.utcnow()
+        if self.app.config.get('ARCHIVE_AFTER_DAYS') and (
+                self.archived_at is None
+                or now - self.archived_at >= ARCHIVE_INTERVAL):
+            self.archive()
+            self.archived_at = now
+
+        if not self.app.config.get('PREWARM_MINUTES'):
+            return self.poll_interval
+        return self.prewarm(now)
+
+    def archive(self):
+        quizzes = archive.archive_finished(
+            self.app.config['ARCHIVE_AFTER_DAYS'])
+        for quiz in quizzes:
+            self.app.logger.info(f'Archived quiz {quiz.id}')
+
+    def prewarm(self, now: dt.datetime) -> float:
+        """Pre-warms the quizzes that are due.
+
+        :return: Seconds until the next quiz is due or the next poll.
+        """
+        horizon = now + self.lead_time \
+            + dt.timedelta(seconds=self.poll_interval)
+        upcoming = model.Quiz.query\
+            .filter(model.Quiz.public.is_(True))\
+            .filter(model.Quiz.start_time_utc > now)\
+            .filter(model.Quiz.start_time_utc <= horizon)\
+            .order_by(model.Quiz.start_time_utc)
+
+        timeout = self.poll_interval
+        for quiz in upcoming:
+            key = (quiz.id, quiz.start_time_utc)
+            if key in self.warmed:
+                continue
+
+            due = quiz.start_time_utc - self.lead_time
+            if due <= now:
+                created = warmup.prewarm_quiz(quiz)
+                self.warmed.add(key)
+                self.app.logger.info(
+                    f'Pre-warmed quiz {quiz.id}, created {created} fills')
+            else:
+                timeout = min(timeout, (due - now).total_seconds())
+
+        return timeout
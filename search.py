@@ -0,0 +1,255 @@
+import html
+import itertools
+import re
+import typing
+
+import sqlalchemy as sa
+from flask import Flask, current_app, has_app_context
+
+import model
+
+
+# FTS5 table of the index, listed in `model.UNMANAGED_TABLES`.
+TABLE = 'search_index'
+
+# Kind of indexed row, stored in the low bits of the rowid.
+KINDS = {model.Quiz: 1, model.Question: 2, model.Choice: 3}
+KIND_NAMES = {1: 'quiz', 2: 'question', 3: 'choice'}
+
+# Markers around the matches in snippets, replaced after escaping.
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+BATCH_SIZE = 1000
+
+TAG = re.compile(r'<[^>]*>')
+SPACE = re.compile(r'\s+')
+WORD = re.compile(r'\w+')
+
+
+def strip_html(content: str) -> str:
+    """Returns the text of HTML content."""
+    text = html.unescape(TAG.sub(' ', content or ''))
+    return SPACE.sub(' ', text).strip()
+
+
+def rowid(kind: int, id_: int) -> int:
+    return id_ * 4 + kind
+
+
+class SearchHit:
+    """Quiz, question or choice matching a search."""
+
+    def __init__(self, row, quiz_names: typing.Dict[int, str]):
+        self.kind = KIND_NAMES[row.rowid % 4]
+        self.id = row.rowid // 4
+        self.quiz_id = row.quiz_id
+        self.question_id = row.question_id
+        self.quiz = quiz_names.get(row.quiz_id)
+        self.snippet = html.escape(row.snippet)\
+            .replace(MATCH_START, '<mark>')\
+            .replace(MATCH_END, '</mark>')
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind,
+            'id': self.id,
+            'quiz_id': self.quiz_id,
+            'question_id': self.question_id,
+            'quiz': self.quiz,
+            'snippet': self.snippet
+        }
+
+
+class Search:
+    """Full-text index of quiz names, question contents and choice values.
+
+    The index is an SQLite FTS5 table, created on the first request and
+    on the first indexed change of a database, and filled from the
+    existing rows when it is created. Changes of quizzes, questions and
+    choices are indexed when the session is flushed, so every way of
+    editing a quiz keeps the index in sync. Other databases and SQLite
+    builds without FTS5 leave search disabled.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.ready = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        app.extensions['search'] = self
+        app.before_first_request(self.prepare)
+
+    def prepare(self):
+        with model.db.engine.begin() as connection:
+            self.ensure_index(connection)
+
+    def ensure_index(self, connection: sa.engine.Connection) -> bool:
+        """Creates and fills the index if needed, returns if it is usable."""
+        key = str(connection.engine.url)
+        if key in self.ready:
+            return self.ready[key]
+
+        ready = False
+        if connection.dialect.name == 'sqlite':
+            exists = connection.execute(
+                sa.text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                name=TABLE).first()
+            try:
+                connection.execute(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+                    f"title, body, quiz_id UNINDEXED, question_id UNINDEXED, "
+                    f"tokenize = 'unicode61 remove_diacritics 2')")
+                ready = True
+            except sa.exc.OperationalError:
+                current_app.logger.warning(
+                    'SQLite has no FTS5, search is disabled')
+            if ready and not exists:
+                self.rebuild(connection)
+
+        self.ready[key] = ready
+        return ready
+
+    def rebuild(self, connection: sa.engine.Connection) -> int:
+        """Indexes every quiz, question and choice again.
+
+        :return: Number of indexed rows.
+        """
+        connection.execute(f"DELETE FROM {TABLE}")
+        count = 0
+        for kind in KINDS:
+            ids = [x for x, in connection.execute(sa.select([kind.id]))]
+            for i in range(0, len(ids), BATCH_SIZE):
+                count += self.index(
+                    connection, kind, ids[i:i + BATCH_SIZE], delete=False)
+        return count
+
+    def index(
+            self,
+            connection: sa.engine.Connection,
+            kind: typing.Type[model.db.Model],
+            ids: typing.Collection[int],
+            delete: bool = True) -> int:
+        """Indexes the rows of kind with the given ids again.
+
+        Ids of deleted rows only remove them from the index.
+
+        :return: Number of indexed rows.
+        """
+        code = KINDS[kind]
+        if delete:
+            connection.execute(
+                sa.text(f"DELETE FROM {TABLE} WHERE rowid IN :rowids")
+                .bindparams(sa.bindparam('rowids', expanding=True)),
+                rowids=[rowid(code, x) for x in ids])
+
+        if kind is model.Quiz:
+            query = sa.select([model.Quiz.id, model.Quiz.name,
+                               sa.literal(''), model.Quiz.id.label('quiz_id'),
+                               sa.literal(None)])\
+                .where(model.Quiz.id.in_(ids))
+        elif kind is model.Question:
+            query = sa.select([model.Question.id, sa.literal(''),
+                               model.Question.content, model.Block.quiz_id,
+                               model.Question.id.label('question_id')])\
+                .select_from(model.Question.__table__.join(model.Block))\
+                .where(model.Question.id.in_(ids))
+        else:
+            query = sa.select([model.Choice.id, sa.literal(''),
+                               model.Choice.value, model.Block.quiz_id,
+                               model.Question.id])\
+                .select_from(model.Choice.__table__
+                             .join(model.Question).join(model.Block))\
+                .where(model.Choice.id.in_(ids))
+
+        rows = [{
+            'rowid': rowid(code, id_),
+            'title': title or '',
+            'body': strip_html(body) if kind is model.Question else body or '',
+            'quiz_id': quiz_id,
+            'question_id': question_id
+        } for id_, title, body, quiz_id, question_id
+            in connection.execute(query)]
+        if rows:
+            connection.execute(sa.text(
+                f"INSERT INTO {TABLE} "
+                f"(rowid, title, body, quiz_id, question_id) "
+                f"VALUES (:rowid, :title, :body, :quiz_id, :question_id)"),
+                rows)
+        return len(rows)
+
+    def index_quiz(self, quiz: model.Quiz) -> int:
+        """Indexes the questions and choices of a quiz.
+
+        Used after inserting a quiz tree with statements the flush listener
+        does not see.
+
+        :return: Number of indexed rows.
+        """
+        connection = model.db.session.connection(mapper=model.Quiz.__mapper__)
+        if not self.ensure_index(connection):
+            return 0
+        tree = model.QuizTree(quiz)
+        choices = [x.id for choices in tree.choices.values() for x in choices]
+        return self.index(connection, model.Question, list(tree.choices)) \
+            + self.index(connection, model.Choice, choices)
+
+    def search(
+            self,
+            text: str,
+            host_id: int = None,
+            limit: int = 20) -> typing.List[SearchHit]:
+        """Returns the best matches of text, ranked by relevance.
+
+        Every word of text must match the beginning of a word.
+
+        :param text: Searched text.
+        :param host_id: Only quizzes of this host are searched if given.
+        :param limit: Maximum number of hits.
+        """
+        words = WORD.findall(text)
+        connection = model.db.session.connection(
+            mapper=model.Quiz.__mapper__)
+        if not words or not self.ensure_index(connection):
+            return []
+
+        query = ' '.join(f'"{x}"*' for x in words)
+        condition = ''
+        if host_id is not None:
+            condition = 'AND quiz_id IN ' \
+                        '(SELECT id FROM quiz WHERE host_id = :host_id)'
+        rows = connection.execute(sa.text(
+            f"SELECT rowid, quiz_id, question_id, "
+            f"snippet({TABLE}, -1, :start, :end, '…', 12) AS snippet "
+            f"FROM {TABLE} WHERE {TABLE} MATCH :query {condition} "
+            f"ORDER BY rank LIMIT :limit"),
+            query=query, host_id=host_id, limit=limit,
+            start=MATCH_START, end=MATCH_END).fetchall()
+
+        quiz_names = dict(model.db.session.query(model.Quiz.id, model.Quiz.name)
+                          .filter(model.Quiz.id.in_({x.quiz_id for x in rows})))
+        return [SearchHit(x, quiz_names) for x in rows]
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_flush')
+def index_changes(session: sa.orm.Session, flush_context):
+    """Indexes the quizzes, questions and choices changed in the flush."""
+    if not has_app_context() or 'search' not in current_app.extensions:
+        return
+
+    changed = {x: set() for x in KINDS}
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if type(obj) in changed and obj.id is not None:
+            changed[type(obj)].add(obj.id)
+    if not any(changed.values()):
+        return
+
+    search = current_app.extensions['search']
+    connection = session.connection(mapper=model.Quiz.__mapper__)
+    if not search.ensure_index(connection):
+        return
+    for kind, ids in changed.items():
+        if ids:
+            search.index(connection, kind, ids)
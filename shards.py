@@ -0,0 +1,189 @@
+import contextlib
+import os
+import threading
+import typing
+
+import sqlalchemy as sa
+from flask import Flask, g, request
+
+import engines
+import model
+
+
+class Shards:
+    """Stores the fills and answers of every quiz in its own SQLite file.
+
+    Enabled by the `SHARD_DIRECTORY` setting. The `SHARD_TABLES` of a quiz
+    live in `quiz-<id>.db` in that directory, while users, quizzes and
+    questions stay in the main database, which every shard connection
+    attaches as `catalogue`. SQLite resolves the unqualified table names
+    of a query in the shard first and in the catalogue next, so joins
+    between answers and questions work unchanged, and a busy quiz only
+    locks its own file.
+
+    Requests with a `quiz_id` view argument use the shard of that quiz,
+    `select` and `using` choose the shard elsewhere. Without a selected
+    shard the fills in the main database are used, and so are they for
+    quizzes that were filled before sharding was enabled. The shard tables
+    are created when a shard is first opened; they are not migrated.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.directory = None
+        self.engines = {}
+        self.unsharded = set()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.directory = app.config.get('SHARD_DIRECTORY')
+        if not self.directory:
+            return
+
+        uri = sa.engine.url.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if uri.get_backend_name() != 'sqlite':
+            raise RuntimeError('Sharding needs an SQLite main database.')
+
+        os.makedirs(self.directory, exist_ok=True)
+        app.extensions['shards'] = self
+        app.before_request(self.select_request_shard)
+
+    def path(self, quiz_id: int) -> str:
+        return os.path.join(self.directory, f'quiz-{quiz_id}.db')
+
+    def exists(self, quiz_id: int) -> bool:
+        return os.path.exists(self.path(quiz_id))
+
+    def engine(self, quiz_id: int) -> sa.engine.Engine:
+        """Returns the engine of the shard of a quiz, creating the shard."""
+        with self.lock:
+            engine = self.engines.get(quiz_id)
+            if engine is None:
+                engine = self._create_engine(quiz_id)
+                self.engines[quiz_id] = engine
+            return engine
+
+    def _create_engine(self, quiz_id: int) -> sa.engine.Engine:
+        main = model.db.get_engine(self.app).url
+        catalogue = main.database
+        profile = engines.get_profile(
+            self.app.config.get('DATABASE_PROFILE'), main)
+        engine = profile.create_engine(f'sqlite:///{self.path(quiz_id)}')
+
+        @sa.event.listens_for(engine, 'connect')
+        def attach_catalogue(connection, record):
+            connection.execute('ATTACH DATABASE ? AS catalogue', (catalogue,))
+
+        tables = [model.db.metadata.tables[x] for x in model.SHARD_TABLES]
+        model.db.metadata.create_all(engine, tables=tables)
+        return engine
+
+    def select(self, quiz_id: typing.Optional[int]):
+        """Selects the shard used by the session in this context."""
+        g.shard = quiz_id
+
+    @contextlib.contextmanager
+    def using(self, quiz_id: int):
+        """Selects the shard of a quiz inside the block."""
+        previous = g.get('shard')
+        self.select(quiz_id)
+        try:
+            yield
+        finally:
+            self.select(previous)
+
+    def current_engine(self) -> typing.Optional[sa.engine.Engine]:
+        quiz_id = g.get('shard')
+        if quiz_id is None:
+            return None
+        return self.engine(quiz_id)
+
+    def is_sharded(self, quiz_id: int) -> bool:
+        """Returns if the fills of a quiz are stored in its shard.
+
+        Quizzes that do not exist are not sharded, so no shard is created
+        for them.
+        """
+        if quiz_id in self.unsharded:
+            return False
+        if self.exists(quiz_id):
+            return True
+
+        engine = model.db.get_engine(self.app)
+        quiz = model.Quiz.__table__
+        if engine.execute(sa.select([quiz.c.id]).where(quiz.c.id == quiz_id)
+                          ).first() is None:
+            return False
+        fill = model.FilledQuiz.__table__
+        filled = engine.execute(
+            sa.select([fill.c.id]).where(fill.c.quiz_id == quiz_id).limit(1)
+        ).first()
+        if filled is not None:
+            self.unsharded.add(quiz_id)
+        return filled is None
+
+    def select_quiz(self, quiz_id: typing.Optional[int]):
+        """Selects the shard of a quiz, or the main database if unsharded."""
+        if quiz_id is not None and not self.is_sharded(quiz_id):
+            quiz_id = None
+        self.select(quiz_id)
+
+    def select_request_shard(self):
+        self.select_quiz((request.view_args or {}).get('quiz_id'))
+
+    def quiz_ids(self) -> typing.List[int]:
+        """Returns the ids of the quizzes that have a shard."""
+        ids = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext == '.db' and stem.startswith('quiz-'):
+                ids.append(int(stem[5:]))
+        return sorted(ids)
+
+    def drop(self, quiz_id: int):
+        """Removes the shard of a deleted quiz with its fills and answers."""
+        with self.lock:
+            engine = self.engines.pop(quiz_id, None)
+        if engine is not None:
+            engine.dispose()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            try:
+                os.remove(self.path(quiz_id) + suffix)
+            except FileNotFoundError:
+                pass
+        self.unsharded.discard(quiz_id)
+
+    def delete_user(self, user_id: int):
+        """Deletes the fills and answers of a deleted user from the shards."""
+        fill = model.FilledQuiz.__table__
+        answer = model.Answer.__table__
+        done = model.FilledQuiz.finished_blocks.property.secondary
+        fill_ids = sa.select([fill.c.id]).where(fill.c.user_id == user_id)
+        for quiz_id in self.quiz_ids():
+            with self.engine(quiz_id).begin() as connection:
+                connection.execute(
+                    answer.delete().where(answer.c.quiz_id.in_(fill_ids)))
+                connection.execute(
+                    done.delete().where(done.c.quiz_id.in_(fill_ids)))
+                connection.execute(
+                    fill.delete().where(fill.c.user_id == user_id))
+
+    def players(self, quiz_ids: typing.Iterable[int]) -> typing.Set[int]:
+        """Returns the ids of the users who filled any of the quizzes.
+
+        The fills are read from the shards of the quizzes and from the
+        main database, which holds the fills from before sharding.
+        """
+        quiz_ids = list(quiz_ids)
+        fill = model.FilledQuiz.__table__
+        query = sa.select([fill.c.user_id]).distinct()
+
+        users = {x for x, in model.db.get_engine(self.app).execute(
+            query.where(fill.c.quiz_id.in_(quiz_ids)))}
+        for quiz_id in quiz_ids:
+            if self.exists(quiz_id):
+                users.update(x for x, in self.engine(quiz_id).execute(query))
+        return users
@@ -0,0 +1,6 @@
+import time
+
+
+# Time the process started importing the application, app.py imports this
+# module before anything else.
+started = time.perf_counter()
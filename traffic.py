@@ -0,0 +1,396 @@
+import collections
+import contextlib
+import glob
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import typing
+
+import sqlalchemy as sa
+from flask import Flask, current_app, g, request, url_for
+from flask_security import current_user
+
+import model
+
+
+# Anonymous requests of the trace are replayed by this many clients.
+ANONYMOUS_CLIENTS = 8
+
+
+def anonymise(value: typing.Any) -> typing.Any:
+    """Returns the shape of a request value without its text.
+
+    Strings are replaced by as many asterisks, except numbers like ids
+    and page numbers, other values are kept.
+    """
+    if isinstance(value, str):
+        return value if value.isdigit() else '*' * len(value)
+    if isinstance(value, list):
+        return [anonymise(x) for x in value]
+    if isinstance(value, dict):
+        return {k: anonymise(v) for (k, v) in value.items()}
+    return value
+
+
+class TrafficRecorder:
+    """Records the requests of the application for replaying them later.
+
+    Enabled by the `TRAFFIC_CAPTURE` setting. Every request is written as
+    a line of JSON to `traffic-<pid>.jsonl` in `TRAFFIC_DIRECTORY`, with
+    its time, duration, status, endpoint, view arguments (ids) and the
+    anonymised query string and payload. Users are replaced by pseudonyms
+    keyed with the secret key of the application, only their role names
+    are kept.
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.directory = None
+        self.file = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.directory = app.config.get('TRAFFIC_DIRECTORY', 'data/traffic')
+        app.extensions['traffic'] = self
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f'traffic-{os.getpid()}.jsonl')
+
+    def pseudonym(self, user_id: typing.Any) -> str:
+        return hmac.new(self.app.secret_key.encode(), str(user_id).encode(),
+                        hashlib.sha256).hexdigest()[:12]
+
+    def start_request(self):
+        if self.app.config.get('TRAFFIC_CAPTURE'):
+            g.traffic_start = time.time()
+
+    def end_request(self, response):
+        start = g.pop('traffic_start', None)
+        if start is None or request.endpoint in (None, 'static'):
+            return response
+
+        record = {
+            'time': start,
+            'duration': time.time() - start,
+            'status': response.status_code,
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'view_args': request.view_args or {},
+            'args': anonymise(request.args.to_dict(flat=False)),
+            'user': None,
+            'roles': [],
+        }
+        if request.is_json:
+            record['json'] = anonymise(request.get_json(silent=True))
+        elif request.form:
+            record['form'] = anonymise(request.form.to_dict(flat=False))
+        if current_user.is_authenticated:
+            record['user'] = self.pseudonym(current_user.get_id())
+            record['roles'] = sorted(x.name for x in current_user.roles)
+
+        self.write(record)
+        return response
+
+    def write(self, record: dict):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file is None or self.file.closed:
+                os.makedirs(self.directory, exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line)
+            self.file.flush()
+
+
+def load_trace(paths: typing.Iterable[str]) -> typing.List[dict]:
+    """Reads recorded requests from files or directories of them.
+
+    :return: The requests ordered by time.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl'))))
+        else:
+            files.append(path)
+
+    records = []
+    for path in files:
+        with open(path, encoding='utf-8') as f:
+            records.extend(json.loads(x) for x in f if x.strip())
+    records.sort(key=lambda x: x['time'])
+    return records
+
+
+class EndpointResult:
+    """Latencies and failures of the replayed requests of an endpoint."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.requests = 0
+        self.errors = 0
+        self.changed = 0
+        self.latencies = []
+
+    def add(self, latency: float, status: int, recorded: int):
+        self.requests += 1
+        self.latencies.append(latency)
+        if status >= 400:
+            self.errors += 1
+        if status // 100 != recorded // 100:
+            self.changed += 1
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0
+
+    def percentile(self, p: float) -> float:
+        """Returns the pth percentile of the latencies in milliseconds."""
+        if len(self.latencies) < 2:
+            return sum(self.latencies) * 1000
+        return statistics.quantiles(self.latencies, n=100)[int(p) - 1] * 1000
+
+    def __str__(self) -> str:
+        return (f'{self.endpoint:<28} {self.requests:7}  '
+                f'p50 {self.percentile(50):7.1f} ms  '
+                f'p95 {self.percentile(95):7.1f} ms  '
+                f'p99 {self.percentile(99):7.1f} ms  '
+                f'errors {self.error_rate:6.1%}  '
+                f'status changed {self.changed:5}')
+
+
+class ReplayResult:
+    """Results of a replay by endpoint, and how late requests were sent."""
+
+    def __init__(self, speed: float):
+        self.speed = speed
+        self.endpoints = {}
+        self.lags = []
+        self.seconds = 0
+        self.lock = threading.Lock()
+
+    def add(self, record: dict, latency: float, status: int, lag: float):
+        with self.lock:
+            endpoint = self.endpoints.get(record['endpoint'])
+            if endpoint is None:
+                endpoint = EndpointResult(record['endpoint'])
+                self.endpoints[record['endpoint']] = endpoint
+            endpoint.add(latency, status, record['status'])
+            self.lags.append(lag)
+
+    @property
+    def total(self) -> EndpointResult:
+        total = EndpointResult('total')
+        for endpoint in self.endpoints.values():
+            total.requests += endpoint.requests
+            total.errors += endpoint.errors
+            total.changed += endpoint.changed
+            total.latencies.extend(endpoint.latencies)
+        return total
+
+    def __str__(self) -> str:
+        lines = [str(x) for (_, x) in sorted(self.endpoints.items())]
+        lines.append(str(self.total))
+        lines.append(f'{self.speed}x speed in {self.seconds:.1f} s, '
+                     f'requests sent up to {max(self.lags, default=0):.2f} s '
+                     f'late')
+        return '\n'.join(lines)
+
+
+def copy_sqlite(source: str, target: str):
+    """Copies an SQLite database with its backup API, safe while in use."""
+    with contextlib.closing(sqlite3.connect(source)) as src, \
+            contextlib.closing(sqlite3.connect(target)) as dst:
+        src.backup(dst)
+
+
+@contextlib.contextmanager
+def cloned_database(app: Flask) -> typing.Iterator[str]:
+    """Points the application at a temporary copy of its SQLite database.
+
+    The shards of the quizzes are copied too if sharding is enabled. The
+    copies are removed on exit, when the original database is restored.
+    Requests are not captured meanwhile.
+    """
+    uri = sa.engine.url.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if uri.get_backend_name() != 'sqlite' or not uri.database:
+        raise ValueError('Replaying needs an SQLite database.')
+    source = os.path.join(app.root_path, uri.database)
+    if not os.path.exists(source):
+        raise ValueError(f'Database {source} does not exist.')
+
+    directory = tempfile.mkdtemp(prefix='replay-')
+    path = os.path.join(directory, 'main.db')
+    copy_sqlite(source, path)
+
+    shards = app.extensions.get('shards')
+    config = {'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}',
+              'WTF_CSRF_ENABLED': False, 'PROPAGATE_EXCEPTIONS': False,
+              'TRAFFIC_CAPTURE': False}
+    previous = {x: app.config.get(x) for x in config}
+    app.config.update(config)
+    if shards is not None:
+        shard_directory, shards.directory = shards.directory, directory
+        for shard in glob.glob(os.path.join(shard_directory, 'quiz-*.db')):
+            copy_sqlite(shard, os.path.join(directory,
+                                            os.path.basename(shard)))
+        shard_engines, shards.engines = shards.engines, {}
+    try:
+        yield path
+    finally:
+        with app.app_context():
+            model.db.session.remove()
+            model.db.get_engine().dispose()
+        if shards is not None:
+            for engine in shards.engines.values():
+                engine.dispose()
+            shards.directory = shard_directory
+            shards.engines = shard_engines
+        app.config.update(previous)
+        shutil.rmtree(directory)
+
+
+def create_users(records: typing.List[dict]) -> typing.Dict[str, int]:
+    """Creates a user for every pseudonym of the trace with its roles.
+
+    :return: User ids by pseudonym.
+    """
+    roles = {}
+    for record in records:
+        if record['user'] is not None:
+            roles.setdefault(record['user'], set()).update(record['roles'])
+
+    existing = {x.name: x for x in model.Role.query}
+    users = {}
+    for i, (pseudonym, names) in enumerate(sorted(roles.items())):
+        for name in names - set(existing):
+            existing[name] = model.Role(name=name)
+            model.db.session.add(existing[name])
+        users[pseudonym] = model.User(
+            username=f'replay{i}-{pseudonym[:6]}',
+            roles=[existing[x] for x in sorted(names)])
+    model.db.session.add_all(users.values())
+    model.db.session.commit()
+    return {k: v.id for (k, v) in users.items()}
+
+
+def create_fills(records: typing.List[dict], users: typing.Dict[str, int]):
+    """Creates the fills of the users where the trace first finds them.
+
+    The blocks before the first block a user requested in a quiz are
+    finished, so a trace recorded in the middle of a quiz replays the
+    same pages instead of being refused.
+    """
+    first = {}
+    for record in records:
+        args = record['view_args']
+        if record['user'] in users and 'quiz_id' in args:
+            key = (users[record['user']], args['quiz_id'])
+            if first.get(key) is None:
+                first[key] = args.get('block')
+
+    shards = current_app.extensions.get('shards')
+    for (user_id, quiz_id), block in sorted(first.items()):
+        quiz = model.Quiz.query.get(quiz_id)
+        if quiz is None:
+            continue
+        context = contextlib.nullcontext()
+        if shards is not None and shards.is_sharded(quiz_id):
+            context = shards.using(quiz_id)
+        with context:
+            fill = model.FilledQuiz.get_or_create(user_id, quiz_id)
+            if block is not None:
+                fill.finished_blocks.extend(
+                    quiz.blocks.filter(model.Block.order_number < block))
+            model.db.session.commit()
+
+
+def record_url(record: dict) -> str:
+    """Returns the url of a recorded request, needs a request context."""
+    return url_for(record['endpoint'],
+                   **dict(record['args'], **record['view_args']))
+
+
+def replay(
+        app: Flask,
+        records: typing.List[dict],
+        speed: float = 1) -> ReplayResult:
+    """Sends the recorded requests to the application on a cloned database.
+
+    The requests of a user are sent by one client in their recorded
+    order, at their recorded time divided by speed, or right after the
+    previous request of the user if that took longer. Every pseudonym is
+    played by a new user with the recorded roles, see `create_users` and
+    `create_fills`, anonymous requests are spread over `ANONYMOUS_CLIENTS`
+    clients.
+
+    :param app: Application to replay the requests on.
+    :param records: Recorded requests ordered by time, see `load_trace`.
+    :param speed: How many times faster than recorded to replay.
+    """
+    result = ReplayResult(speed)
+    if not records:
+        return result
+
+    with cloned_database(app):
+        with app.app_context():
+            users = create_users(records)
+            create_fills(records, users)
+
+        queues = collections.defaultdict(list)
+        with app.test_request_context():
+            for i, record in enumerate(records):
+                key = record['user']
+                if key is None:
+                    key = f'anonymous-{i % ANONYMOUS_CLIENTS}'
+                queues[key].append((record_url(record), record))
+
+        first = records[0]['time']
+        started = time.perf_counter()
+
+        def play(key: str, queue: typing.List[typing.Tuple[str, dict]]):
+            client = app.test_client()
+            if key in users:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(users[key])
+                    session['_fresh'] = True
+
+            for url, record in queue:
+                due = started + (record['time'] - first) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                sent = time.perf_counter()
+                options = {'method': record['method']}
+                if 'json' in record:
+                    options['json'] = record['json']
+                elif 'form' in record:
+                    options['data'] = record['form']
+                response = client.open(url, **options)
+                result.add(record, time.perf_counter() - sent,
+                           response.status_code, max(0, sent - due))
+
+        threads = [threading.Thread(target=play, args=x, daemon=True)
+                   for x in queues.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result.seconds = time.perf_counter() - started
+        app.extensions['grader'].drain(30)
+
+    return result
+
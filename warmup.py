@@ -0,0 +1,121 @@
+import contextlib
+import logging
+import os
+import time
+import typing
+
+from flask import Flask
+from jinja2 import FileSystemBytecodeCache
+
+import model
+
+
+# Template prefixes compiled by the warm-up besides the application's own.
+TEMPLATE_PREFIXES = ('admin/', 'bootstrap/', 'security/')
+
+
+def init_bytecode_cache(app: Flask):
+    """Stores compiled templates on the filesystem, shared by all workers."""
+    directory = app.config.get('JINJA_CACHE_DIRECTORY', 'data/cache/jinja')
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def compile_templates(app: Flask) -> typing.List[str]:
+    """Compiles the templates the application renders.
+
+    The application's own templates and the Flask-Admin, Flask-Bootstrap
+    and Flask-Security templates are compiled, so their bytecode ends up
+    in the cache.
+    """
+    own = set(os.listdir(os.path.join(app.root_path, app.template_folder)))
+
+    names = []
+    for name in app.jinja_env.list_templates(extensions=['html', 'txt']):
+        if name.split('/')[0] in own or name.startswith(TEMPLATE_PREFIXES):
+            app.jinja_env.get_template(name)
+            names.append(name)
+    return names
+
+
+def warm_up_urls(app: Flask) -> typing.List[typing.Tuple[str, int]]:
+    """Returns the pages to render and the users to request them as.
+
+    Besides the index and login pages, the editor page of the newest quiz
+    and the pager and a question page of its newest fill are requested.
+    These requests only read the database.
+    """
+    urls = [('/', None), ('/login', None)]
+    with app.app_context():
+        quiz = model.Quiz.query\
+            .filter(model.Quiz.archived_utc.is_(None))\
+            .order_by(model.Quiz.id.desc()).first()
+        if quiz is None:
+            return urls
+        urls.append((f'/quiz/edit/?id={quiz.id}', quiz.host_id))
+
+        storage = contextlib.nullcontext()
+        shards = app.extensions.get('shards')
+        if shards is not None and shards.is_sharded(quiz.id):
+            storage = shards.using(quiz.id)
+        with storage:
+            fill = model.FilledQuiz.query.filter_by(quiz_id=quiz.id)\
+                .order_by(model.FilledQuiz.id.desc()).first()
+            block = fill and model.Pager(fill).block
+            if block is not None:
+                urls.append((f'/{quiz.id}/pager', fill.user_id))
+                urls.append((f'/{quiz.id}/{block.order_number}/1',
+                             fill.user_id))
+        model.db.session.remove()
+    return urls
+
+
+def render_views(app: Flask):
+    """Renders the player and editor pages once from the database.
+
+    Rendering fills the template, translation and admin menu caches of
+    the process and opens its database connections.
+    """
+    client = app.test_client()
+    for url, user_id in warm_up_urls(app):
+        with client.session_transaction() as session:
+            session.clear()
+            if user_id is not None:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+        client.get(url)
+
+
+def warm_up(app: Flask):
+    """Compiles and renders the templates before the worker takes traffic.
+
+    Called by the `post_worker_init` hook in gunicorn.conf.py and before
+    the development server starts. Failures are logged only, the worker
+    starts cold then.
+    """
+    started = time.perf_counter()
+    try:
+        compile_templates(app)
+        render_views(app)
+    except Exception:
+        app.logger.exception('Warming up failed')
+    else:
+        app.logger.log(
+            logging.getLevelName(app.config['STARTUP_LOG_LEVEL']),
+            f'Warmed up in {time.perf_counter() - started:.2f} s')
+
+
+def prewarm_quiz(quiz: model.Quiz) -> int:
+    """Prepares a quiz before its players arrive.
+
+    Loads the timeline and the answer keys of the quiz into the cache and
+    creates the fills of the players of the host's earlier quizzes, so the
+    first requests after the start find everything in place.
+
+    :return: Number of fills created.
+    """
+    model.quiz_timeline(quiz)
+    model.answer_keys(quiz)
+    created = model.create_fills(quiz)
+    model.db.session.commit()
+    return created